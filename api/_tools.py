@@ -1,5 +1,6 @@
 """Различные мелкие полезные утилиты."""
 import asyncio
+import collections
 import contextlib
 import datetime
 import itertools
@@ -13,15 +14,20 @@ _T = t.TypeVar('_T')
 
 
 async def aiobatch(src: t.AsyncIterable[_T], batch_size: int) -> t.AsyncIterable[list[_T]]:
-    """Группирует содержимое асинхронного генератора `src` в пакеты по `batch_size` элементов."""
-    batch_list = []
+    """Группирует содержимое асинхронного генератора `src` в пакеты по `batch_size` элементов.
+    Каждый пакет - новый список, так что получатель может сохранять ссылки на него."""
+    batch_size = max(1, batch_size)
+    batch_list: list = [None] * batch_size
+    count = 0
     async for item in src:
-        batch_list.append(item)
-        if len(batch_list) >= batch_size:
+        batch_list[count] = item
+        count += 1
+        if count == batch_size:
             yield batch_list
-            batch_list = []
-    if batch_list:
-        yield batch_list
+            batch_list = [None] * batch_size
+            count = 0
+    if count:
+        yield batch_list[:count]
 
 
 def done_callback(task: asyncio.Task):
@@ -156,7 +162,8 @@ class IntervalScheduler(t.Generic[_T]):
         self.duration: datetime.timedelta = duration
         self.batch_size: int = batch_size
         self.alignment = min(1.0, max(0.0, alignment))
-        self.events: list[tuple[datetime.datetime, tuple[_T, ...]]] = []
+        # события упорядочены по возрастанию времени, так что сработавшие всегда находятся в начале очереди
+        self.events: collections.deque[tuple[datetime.datetime, tuple[_T, ...]]] = collections.deque()
 
     def is_empty(self) -> bool:
         """Возвращает истину, если не осталось опрашиваемых объектов, и список пора обновить."""
@@ -200,12 +207,10 @@ class IntervalScheduler(t.Generic[_T]):
         :param now: Текущий момент времени.
         :returns: Список объектов, которые следует опросить. Может быть пуст."""
         now = now.astimezone(datetime.timezone.utc)
+        events = self.events
         past = []
-        for i in range(len(self.events) - 1, -1, -1):
-            ts, objects = self.events[i]
-            if ts <= now:
-                del self.events[i]
-                past.extend(objects)
+        while events and events[0][0] <= now:
+            past.extend(events.popleft()[1])
         return past
 
     def get_next_trigger_time(self) -> t.Optional[datetime.datetime]:
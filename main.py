@@ -62,4 +62,9 @@ async def main():
 
 if __name__ == '__main__':
     import asyncio
-    asyncio.run(main())
+    try:  # uvloop заметно снижает накладные расходы цикла событий, но доступен не на всех платформах
+        import uvloop
+    except ImportError:
+        asyncio.run(main())
+    else:
+        asyncio.run(main(), loop_factory=uvloop.new_event_loop)
@@ -1,5 +1,7 @@
 """Предоставляет доступ к базе данных через посредничество асинхронного варианта SQLAlchemy."""
 import typing as t
+import contextlib
+import dataclasses
 import os
 import logging
 
@@ -11,8 +13,26 @@ requires = []
 provides = [AsyncEngine]
 
 
+@dataclasses.dataclass
+class DBConfig:
+    """Конфигурация пула соединений с базой данных."""
+    pool_size: int = 4
+    max_overflow: int = 4
+    statement_cache_size: int = 256
+    pool_pre_ping: bool = True
+    pool_recycle_seconds: int = 1800
+
+
+async def warmup_pool(engine: AsyncEngine, count: int) -> None:
+    """Заранее открывает указанное число соединений, чтобы первые обращения к БД не ждали их установки."""
+    async with contextlib.AsyncExitStack() as stack:
+        for _ in range(count):
+            await stack.enter_async_context(engine.connect())
+
+
 async def lifetime(api: CoreAPI) -> t.AsyncGenerator:
     """Тело модуля."""
+    cfg = await api.config.load('db', DBConfig)
     host = os.environ['POSTGRES_HOST']
     user = os.environ['POSTGRES_USER']
     pwd = os.environ['POSTGRES_PASSWORD']
@@ -20,8 +40,17 @@ async def lifetime(api: CoreAPI) -> t.AsyncGenerator:
     dsn = f'postgresql+asyncpg://{user}:{pwd}@{host}/{dbname}'
     log = logging.getLogger('modules.db')
     log.info('Connecting to database...')
-    engine = create_async_engine(dsn)
+    engine = create_async_engine(
+        dsn,
+        pool_size=cfg.pool_size,
+        max_overflow=cfg.max_overflow,
+        pool_pre_ping=cfg.pool_pre_ping,
+        pool_recycle=cfg.pool_recycle_seconds,
+        connect_args={'prepared_statement_cache_size': cfg.statement_cache_size},
+    )
+    await warmup_pool(engine, cfg.pool_size)
     log.info('Connected successfuly to %s@%s', dbname, host)
+    log.debug('Connection pool: %s', engine.pool.status())
     api.register_api_provider(engine, AsyncEngine)
     yield
     log.info('Disconnected from database.')
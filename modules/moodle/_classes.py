@@ -1,4 +1,5 @@
-"""Набор DTO-классов, описывающих сущности Moodle."""
+"""Набор DTO-классов, описывающих сущности Moodle.
+Все отметки времени в них имеют часовой пояс UTC - он назначается один раз при разборе ответа сервера."""
 import typing as t
 import dataclasses
 import datetime
@@ -20,19 +21,19 @@ submission_id = t.NewType('submission_id', int)
 
 
 class _IDMixin(t.Generic[_IDType]):
+    """Сравнивает и хэширует сущности только по ID.
+    Наследники должны объявляться с eq=False, иначе dataclass заменит эти методы на сравнение всех полей."""
+    __slots__ = ()
     id: _IDType
 
     def __hash__(self) -> int:
         return hash(self.id)
 
     def __eq__(self, other) -> bool:
-        return self.id == other.id
+        return self is other or (type(self) is type(other) and self.id == other.id)
 
-    def __ne__(self, other) -> bool:
-        return self.id == other.id
 
-
-@dataclasses.dataclass(frozen=True, init=True)
+@dataclasses.dataclass(frozen=True, init=True, eq=False, slots=True)
 class User(_IDMixin[user_id]):
     """Пользователь Moodle. Уникален в рамках сервера Moodle."""
     id: user_id
@@ -40,21 +41,21 @@ class User(_IDMixin[user_id]):
     email: t.Optional[str] = None
 
 
-@dataclasses.dataclass(frozen=True, init=True)
+@dataclasses.dataclass(frozen=True, init=True, eq=False, slots=True)
 class Role(_IDMixin[role_id]):
     """Роль пользователя Moodle. Уникальна в рамках сервера Moodle."""
     id: role_id
     name: str
 
 
-@dataclasses.dataclass(frozen=True, init=True)
+@dataclasses.dataclass(frozen=True, init=True, eq=False, slots=True)
 class Group(_IDMixin[group_id]):
     """Группа пользователей в курсе Moodle. Имеет уникальный ID, но определена в рамках курса."""
     id: group_id
     name: str
 
 
-@dataclasses.dataclass(frozen=True, init=True)
+@dataclasses.dataclass(frozen=True, init=True, slots=True)
 class Participant:
     """Участник курса Moodle. В контексте курса он имеет набор ролей и групп."""
     user: User
@@ -67,7 +68,7 @@ class Participant:
         else:
             return self.user == other
 
-    def __neq__(self, other: t.Union['Participant', User]) -> bool:
+    def __ne__(self, other: t.Union['Participant', User]) -> bool:
         if isinstance(other, Participant):
             return self.user != other.user
         else:
@@ -77,7 +78,7 @@ class Participant:
         return hash(self.user)
 
 
-@dataclasses.dataclass(frozen=True, init=True)
+@dataclasses.dataclass(frozen=True, init=True, eq=False, slots=True)
 class Course(_IDMixin[course_id]):
     """Описывает один курс в Moodle."""
     id: course_id
@@ -88,7 +89,7 @@ class Course(_IDMixin[course_id]):
     ends: t.Optional[datetime.datetime] = None
 
 
-@dataclasses.dataclass(frozen=True, init=True)
+@dataclasses.dataclass(frozen=True, init=True, eq=False, slots=True)
 class Assignment(_IDMixin[assignment_id]):
     """Описывает задание в Moodle."""
     id: assignment_id
@@ -99,7 +100,7 @@ class Assignment(_IDMixin[assignment_id]):
     cutoff: t.Optional[datetime.datetime]
 
 
-@dataclasses.dataclass(frozen=True, init=True)
+@dataclasses.dataclass(frozen=True, init=True, slots=True)
 class SubmittedFile:
     """Описывает файл, прикреплённый к ответу на задание в Moodle."""
     submission_id: submission_id
@@ -119,7 +120,7 @@ class SubmittedFile:
         return hash((self.submission_id, self.filename))
 
 
-@dataclasses.dataclass(frozen=True, init=True)
+@dataclasses.dataclass(frozen=True, init=True, eq=False, slots=True)
 class Submission(_IDMixin[submission_id]):
     """Описывает ответ на задание в Moodle."""
     id: submission_id
@@ -212,7 +212,9 @@ class Moodle:
         """Transforms a timestamp into a :class:`datetime.datetime` instance according to server timezone.
         :param ts: Unix-style timestamp or None.
         :returns: A :class:`datetime.datetime` instance, if a timestamp was given, otherwise None."""
-        return datetime.datetime.fromtimestamp(ts, self.timezone).astimezone(datetime.timezone.utc) \
+        # a timestamp denotes the same instant in any timezone, so we build the UTC value directly
+        # instead of converting from server timezone - this is called for every date field of every entity
+        return datetime.datetime.fromtimestamp(ts, datetime.timezone.utc) \
             if isinstance(ts, int) and ts > 0 else None
 
     def datetime2timestamp(self, dt: Optional[datetime.datetime]) -> Optional[int]:
@@ -1,5 +1,6 @@
 """Отслеживает изменения на сервере Moodle и кэширует их в локальной БД для использования другими модулями."""
 import logging
+import typing as t
 
 from sqlalchemy.ext.asyncio import AsyncEngine
 from aiogram import Bot, Dispatcher, Router
@@ -25,6 +26,16 @@ provides = [MoodleRepository]
 tgrouter = Router(name='moodle_monitoring')
 
 
+def _pool_capacity(engine: AsyncEngine) -> t.Optional[int]:
+    """Возвращает, сколько соединений пул движка может выдать одновременно, или None, если число не ограничено."""
+    pool = engine.pool
+    size = getattr(pool, 'size', None)
+    max_overflow = getattr(pool, '_max_overflow', None)
+    if size is None or max_overflow is None or max_overflow < 0:
+        return None
+    return size() + max_overflow
+
+
 async def lifetime(api: CoreAPI):
     """Контекст работы модуля мониторинга Moodle. Код до yield инициализирует работу, после - завершает."""
     log = logging.getLogger('modules.moodlemon')
@@ -35,11 +46,13 @@ async def lifetime(api: CoreAPI):
     await repo.create_tables()
     api.register_api_provider(repo, MoodleRepository)
 
-    scheduler = Scheduler(cfg, log, moodle, repo)
+    scheduler = Scheduler(cfg, log, moodle, repo, max_connections=_pool_capacity(engine))
 
     @tgrouter.message(tg_is_site_admin, Command('moodle_scan_now'))
     async def force_moodle_scan(msg: Message):
         """Принудительно запускает сканирование СДО на предмет новых ответов на задания."""
+        # принудительное сканирование должно заново синхронизировать и участников курсов
+        repo.forget_participant_digests()
         scheduler.wakeup.set()
         log.info('User %s ( %s ) forced a scan.', msg.from_user.full_name, msg.from_user.id)
         await msg.answer('Сканирование СДО запущено.')
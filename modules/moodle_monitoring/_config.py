@@ -16,7 +16,6 @@ class MoodleMonitorAssignmentConfig:
     """Конфигурация отслеживания заданий."""
     update_interval_seconds: int = 60*60*12
     update_course_batch_size: int = 1
-    db_batch_size: int = 5
     deadline_before_seconds: int = 60*60*2
     deadline_after_seconds: int = 60*30
 
@@ -29,6 +28,7 @@ class MoodleMonitorSubmissionConfig:
     update_deadline_interval_seconds: int = 60*3
     update_deadline_batch_size: int = 1
     db_batch_size: int = 5
+    concurrency: int = 4  # урезается до ёмкости пула соединений с БД минус одно соединение
 
 
 @dataclasses.dataclass
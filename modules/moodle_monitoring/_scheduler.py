@@ -5,7 +5,7 @@ import collections
 import datetime
 import logging
 
-from modules.moodle import MoodleAdapter, course_id, assignment_id
+from modules.moodle import MoodleAdapter, Assignment, course_id, assignment_id
 from api import IntervalScheduler, aiobatch
 from ._config import MoodleMonitorConfig
 from .models import MoodleRepository
@@ -18,12 +18,21 @@ class Scheduler:
     """Реализует периодический опрос сервера Moodle и кэширует результаты в БД.
     Распределяет запросы по интервалу времени, чтобы снизить пиковую нагрузку."""
     def __init__(self, cfg: MoodleMonitorConfig, log: logging.Logger,
-                 moodle: MoodleAdapter, repo: MoodleRepository):
+                 moodle: MoodleAdapter, repo: MoodleRepository, max_connections: t.Optional[int]):
         self.__moodle = moodle
         self.__repo = repo
         self.__cfg = cfg
         self.__log = log
         self.wakeup = asyncio.Event()
+        # одно соединение пула остаётся за обновлением заданий, остальные делят между собой загрузки ответов.
+        # max_connections = None означает, что пул не ограничивает число соединений
+        concurrency = max(1, self.__cfg.submissions.concurrency)
+        if max_connections is not None:
+            concurrency = max(1, min(concurrency, max_connections - 1))
+        if concurrency < self.__cfg.submissions.concurrency:
+            self.__log.warning('submissions.concurrency = %d exceeds database pool capacity of %d connections, '
+                               'limiting it to %d.', self.__cfg.submissions.concurrency, max_connections, concurrency)
+        self.__submission_slots = asyncio.Semaphore(concurrency)
         self.__update_courses = IntervalScheduler[None](
             duration=datetime.timedelta(seconds=self.__cfg.courses.update_interval_seconds),
             batch_size=1, alignment=0.0
@@ -49,17 +58,53 @@ class Scheduler:
         forced = False
         while True:
             now = datetime.datetime.now(datetime.timezone.utc)
-            await self._check_courses(now, forced)
-            await self._check_assignments(now, forced)
-            await self._check_submissions_deadline(now, forced)
-            await self._check_submissions_active(now, forced)
+            if forced or self._is_due(self.__update_courses, now):
+                await self._check_courses(now, forced)
+            if forced or self._is_due(self.__update_deadline_submissions, now) \
+                    or self._is_due(self.__update_open_submissions, now):
+                await self._refresh_active_assignments(now)
+            # задания и ответы обновляются независимо друг от друга, каждая проверка берёт своё соединение из пула
+            checks = []
+            if forced or self._is_due(self.__update_assignments, now):
+                checks.append(self._check_assignments(now, forced))
+            deadline_ids = self._pop_submission_batch(self.__update_deadline_submissions, now, forced)
+            open_ids = self._pop_submission_batch(self.__update_open_submissions, now, forced)
+            # задание, перешедшее в интервал сроков, может ещё стоять и в очереди открытых заданий -
+            # обрабатываем его один раз, чтобы две транзакции не сохраняли одни и те же ответы одновременно
+            if deadline_ids and open_ids:
+                in_deadline = set(deadline_ids)
+                open_ids = [aid for aid in open_ids if aid not in in_deadline]
+            if deadline_ids:
+                checks.append(self._update_submissions_for(deadline_ids))
+            if open_ids:
+                checks.append(self._update_submissions_for(open_ids))
+            await asyncio.gather(*checks)
             try:
                 self.wakeup.clear()
-                await asyncio.wait_for(self.wakeup.wait(), self.__cfg.wakeup_interval_seconds)
+                async with asyncio.timeout(self._get_sleep_time().total_seconds()):
+                    await self.wakeup.wait()
                 forced = True
-            except asyncio.TimeoutError:
+            except TimeoutError:
                 forced = False
 
+    def _is_due(self, sched: IntervalScheduler, now: datetime.datetime) -> bool:
+        """Возвращает истину, если планировщик пора обработать: он пуст и требует обновления,
+        или у него есть сработавшие объекты."""
+        next_time = sched.get_next_trigger_time()
+        return next_time is None or next_time <= now
+
+    def _get_sleep_time(self) -> datetime.timedelta:
+        """Вычисляет, сколько можно спать до ближайшего срабатывания любого из планировщиков.
+        Ожидание не превышает wakeup_interval_seconds, чтобы пустые планировщики вовремя обновлялись."""
+        now = datetime.datetime.now(datetime.timezone.utc)
+        delay = datetime.timedelta(seconds=self.__cfg.wakeup_interval_seconds)
+        for sched in (self.__update_courses, self.__update_assignments,
+                      self.__update_deadline_submissions, self.__update_open_submissions):
+            next_time = sched.get_next_trigger_time()
+            if next_time is not None:
+                delay = min(delay, next_time - now)
+        return max(delay, datetime.timedelta(seconds=0))
+
     async def _check_courses(self, now: datetime.datetime, forced: bool) -> None:
         if self.__update_courses.is_empty():
             self.__update_courses.set_queried_objects([None], now)
@@ -74,8 +119,8 @@ class Scheduler:
                     in_progress_only=self.__cfg.courses.load_inprogress_only,
                     batch_size=self.__cfg.courses.db_batch_size
                 )
-                async for chunk in aiobatch(course_stream, self.__cfg.courses.db_batch_size):
-                    await self.__repo.store_courses(chunk, now)
+                await self.__repo.store_course_batches(
+                    aiobatch(course_stream, self.__cfg.courses.db_batch_size), now)
             except Exception as err:
                 self.__log.error('Failed to update courses!', exc_info=err)
             else:
@@ -100,12 +145,15 @@ class Scheduler:
             try:
                 self.__log.debug('Updating assignments for courses %s',
                                  ', '.join(f'#{cid}' for cid in course_ids))
-                assign_stream = self.__moodle.stream_assignments(course_ids)
                 known_assignments: dict[course_id, list[assignment_id]] = collections.defaultdict(list)
-                async for chunk in aiobatch(assign_stream, self.__cfg.assignments.db_batch_size):
-                    for a in chunk:
+
+                async def track_assignments(stream: t.AsyncIterable[Assignment]) -> t.AsyncIterable[Assignment]:
+                    async for a in stream:
                         known_assignments[a.course_id].append(a.id)
-                    await self.__repo.store_assignments(chunk)
+                        yield a
+
+                assign_stream = self.__moodle.stream_assignments(course_ids)
+                await self.__repo.store_assignment_stream(track_assignments(assign_stream))
                 await self.__repo.drop_assignments_except_for(known_assignments)
             except Exception as err:
                 self.__log.error('Failed to update assignments!', exc_info=err)
@@ -115,60 +163,59 @@ class Scheduler:
                                     f'#{cid}({len(known_assignments.get(cid, []))} items)' for cid in course_ids
                                 ))
 
-    async def _check_submissions_active(self, now: datetime.datetime, forced: bool) -> None:
-        """Проверяет, нет ли новых ответов на задания, которые завершаются ещё не скоро."""
-        if self.__update_open_submissions.is_empty():
-            try:
-                assigns = await self.__repo.get_active_assignment_ids_not_ending_soon(
-                    now=now,
-                    before=datetime.timedelta(seconds=self.__cfg.assignments.deadline_before_seconds),
-                    after=datetime.timedelta(seconds=self.__cfg.assignments.deadline_after_seconds)
-                )
-            except Exception as err:
-                self.__log.error('Failed to get active assignments!', exc_info=err)
-            else:
-                self.__log.debug('Tracking %d open non-deadline assignments.', len(assigns))
-                self.__update_open_submissions.set_queried_objects(assigns, now)
-        if forced:
-            assign_ids = self.__update_open_submissions.pop_all_objects()
-        else:
-            assign_ids = self.__update_open_submissions.pop_triggered_objects(now)
-        if assign_ids:
-            await self._update_submissions_for(assign_ids)
+    async def _refresh_active_assignments(self, now: datetime.datetime) -> None:
+        """Заново заполняет опустевшие планировщики ответов на задания.
+        Оба списка заданий (со сроком в ближайшее время и остальные) загружаются одним запросом."""
+        refresh_deadline = self.__update_deadline_submissions.is_empty()
+        refresh_open = self.__update_open_submissions.is_empty()
+        if not (refresh_deadline or refresh_open):
+            return
+        try:
+            deadline, not_deadline = await self.__repo.get_active_assignment_ids_partitioned(
+                now=now,
+                before=datetime.timedelta(seconds=self.__cfg.assignments.deadline_before_seconds),
+                after=datetime.timedelta(seconds=self.__cfg.assignments.deadline_after_seconds)
+            )
+        except Exception as err:
+            self.__log.error('Failed to get active assignments!', exc_info=err)
+            return
+        if refresh_deadline:
+            self.__log.debug('Tracking %d open deadline assignments.', len(deadline))
+            self.__update_deadline_submissions.set_queried_objects(deadline, now)
+        if refresh_open:
+            self.__log.debug('Tracking %d open non-deadline assignments.', len(not_deadline))
+            self.__update_open_submissions.set_queried_objects(not_deadline, now)
 
-    async def _check_submissions_deadline(self, now: datetime.datetime, forced: bool) -> None:
-        """Проверяет, нет ли новых ответов на задания, которые скоро завершатся."""
-        if self.__update_deadline_submissions.is_empty():
-            try:
-                assigns = await self.__repo.get_active_assignment_ids_ending_soon(
-                    now=now,
-                    before=datetime.timedelta(seconds=self.__cfg.assignments.deadline_before_seconds),
-                    after=datetime.timedelta(seconds=self.__cfg.assignments.deadline_after_seconds),
-                    )
-            except Exception as err:
-                self.__log.error('Failed to get active assignments!', exc_info=err)
-            else:
-                self.__log.debug('Tracking %d open deadline assignments.', len(assigns))
-                self.__update_deadline_submissions.set_queried_objects(assigns, now)
+    def _pop_submission_batch(self, sched: IntervalScheduler[assignment_id], now: datetime.datetime,
+                              forced: bool) -> list[assignment_id]:
+        """Извлекает из планировщика ответов задания, которые пора проверить (при принудительном опросе - все)."""
         if forced:
-            assign_ids = self.__update_deadline_submissions.pop_all_objects()
-        else:
-            assign_ids = self.__update_deadline_submissions.pop_triggered_objects(now)
-        if assign_ids:
-            await self._update_submissions_for(assign_ids)
+            return sched.pop_all_objects()
+        if self._is_due(sched, now):
+            return sched.pop_triggered_objects(now)
+        return []
 
     async def _update_submissions_for(self, assign_ids: t.Collection[assignment_id]):
-        """Скачивает и сохраняет ответы на указанные задания."""
+        """Скачивает и сохраняет ответы на указанные задания.
+        Задания обрабатываются параллельно, но не более submissions.concurrency одновременно
+        с учётом всех одновременных вызовов, так как каждое из них удерживает соединение из пула."""
         try:
-            subtimes = await self.__repo.get_last_submission_times(assign_ids)
-            for aid, lastsub in subtimes.items():
-                self.__log.debug('Updating submissions for assignment #%d...', aid)
-                start_time = lastsub + datetime.timedelta(seconds=1) if lastsub is not None else None
-                assign_stream = self.__moodle.stream_submissions(aid, submitted_after=start_time)
-                total = 0
-                async for chunk in aiobatch(assign_stream, self.__cfg.submissions.db_batch_size):
-                    total += len(chunk)
-                    await self.__repo.store_submissions(chunk)
-                self.__log.debug('Found %d new submissions for assignment #%d.', total, aid)
+            async with self.__submission_slots:
+                subtimes = await self.__repo.get_last_submission_times(assign_ids)
         except Exception as err:
             self.__log.error('Failed to update submissions!', exc_info=err)
+            return
+
+        async def update_one(aid: assignment_id, lastsub: t.Optional[datetime.datetime]) -> None:
+            async with self.__submission_slots:
+                try:
+                    self.__log.debug('Updating submissions for assignment #%d...', aid)
+                    start_time = lastsub + datetime.timedelta(seconds=1) if lastsub is not None else None
+                    assign_stream = self.__moodle.stream_submissions(aid, submitted_after=start_time)
+                    total = await self.__repo.store_submission_batches(
+                        aiobatch(assign_stream, self.__cfg.submissions.db_batch_size))
+                    self.__log.debug('Found %d new submissions for assignment #%d.', total, aid)
+                except Exception as err:
+                    self.__log.error('Failed to update submissions for assignment #%d!', aid, exc_info=err)
+
+        await asyncio.gather(*(update_one(aid, lastsub) for aid, lastsub in subtimes.items()))
@@ -1,7 +1,7 @@
 """Описывает модель задания (assignment) и ответа (submission) для кэша сущностей Moodle."""
 from datetime import datetime
 
-from sqlalchemy import ForeignKey, Sequence, DateTime
+from sqlalchemy import ForeignKey, Sequence, DateTime, Index
 from sqlalchemy.orm import Mapped, mapped_column
 
 from .base import MoodleBase
@@ -16,7 +16,8 @@ class MoodleAssignment(MoodleBase):
     id: Mapped[int] = mapped_column(primary_key=True, comment='ID задания')
     course_id: Mapped[int] = mapped_column(
         ForeignKey(MoodleCourse.id, ondelete="cascade"),
-        comment='ID курса, которому принадлежит задание')
+        comment='ID курса, которому принадлежит задание',
+        index=True)
     name: Mapped[str] = mapped_column(nullable=False, comment='Название задания')
     opening: Mapped[datetime] = mapped_column(DateTime(timezone=True), nullable=True, index=True,
                                               comment='Когда задание открывается')
@@ -51,7 +52,6 @@ class MoodleSubmittedFile(MoodleBase):
         comment='ID ответа, к которому прикреплён этот файл')
     assignment_id: Mapped[int] = mapped_column(
         ForeignKey(MoodleAssignment.id, ondelete='cascade'),
-        index=True,
         comment='ID задания, к ответу на которое прикреплён этот файл')
     user_id: Mapped[int] = mapped_column(
         ForeignKey(MoodleUser.id, ondelete='cascade'),
@@ -62,3 +62,8 @@ class MoodleSubmittedFile(MoodleBase):
     url: Mapped[str] = mapped_column(nullable=False, comment='URL для скачивания файла (потребуется токен)')
     uploaded: Mapped[datetime] = mapped_column(DateTime(timezone=True), nullable=False, index=True,
                                                comment='Когда файл был загружен')
+    __table_args__ = (
+        # файлы выбираются по заданию (и пользователю) в порядке загрузки; заменяет индекс по assignment_id,
+        # который удаляется из существующих БД в MoodleRepository.create_tables()
+        Index('ix_moodle_submitted_files_assignment_user_uploaded', 'assignment_id', 'user_id', 'uploaded'),
+    )
@@ -1,7 +1,7 @@
 """Описывает модели курса Moodle и групп в курсе для кэша сущностей Moodle."""
 from datetime import datetime
 
-from sqlalchemy import ForeignKey, DateTime
+from sqlalchemy import ForeignKey, DateTime, Index, text
 from sqlalchemy.orm import Mapped, mapped_column
 
 from .base import MoodleBase
@@ -18,6 +18,12 @@ class MoodleCourse(MoodleBase):
     ends: Mapped[datetime] = mapped_column(DateTime(timezone=True), nullable=True, comment='Когда курс закрывается')
     last_seen: Mapped[datetime] = mapped_column(DateTime(timezone=True), nullable=False, server_default='NOW()',
                                                 comment='Когда курс упоминался последний раз')
+    __table_args__ = (
+        # поиск открытых курсов по интервалу дат; частичный индекс - для курсов, у которых указаны обе даты
+        Index('ix_moodle_courses_window', 'starts', 'ends'),
+        Index('ix_moodle_courses_window_dated', 'starts', 'ends',
+              postgresql_where=text('starts IS NOT NULL AND ends IS NOT NULL')),
+    )
 
 
 class MoodleGroup(MoodleBase):
@@ -25,5 +31,6 @@ class MoodleGroup(MoodleBase):
     id: Mapped[int] = mapped_column(primary_key=True, comment='ID группы (уникальное в рамках сервера)')
     course_id: Mapped[int] = mapped_column(
         ForeignKey(MoodleCourse.id, ondelete='cascade'),
-        comment='ID курса, в котором описана группа')
+        comment='ID курса, в котором описана группа',
+        index=True)
     name: Mapped[str] = mapped_column(nullable=False, comment='Название группы')
@@ -1,12 +1,18 @@
 """Реализует репозиторий для работы с локальным кэшем сущностей Moodle."""
 import typing as t
 from datetime import datetime, timezone, timedelta
-from collections import defaultdict
+import functools
+import hashlib
+import itertools
+import operator
 import logging
+import time
 
 from sqlalchemy.ext.asyncio import AsyncEngine, async_sessionmaker, AsyncSession
-from sqlalchemy import select, delete, or_, and_, tuple_, func
-from sqlalchemy.dialects.postgresql import insert as upsert
+from sqlalchemy.engine import Connection
+from sqlalchemy import (select, delete, Delete, exists, or_, and_, any_, literal, func, text, table, column,
+                        TableClause, ColumnElement, Select, bindparam, Integer, JSON)
+from sqlalchemy.dialects.postgresql import insert as upsert, Insert, ARRAY
 
 from modules.moodle import (Course, Participant, User, Role, Group, Assignment, Submission, SubmittedFile,
                             user_id, course_id, assignment_id)
@@ -20,285 +26,489 @@ from .assignment import *
 __all__ = ['MoodleRepository']
 
 
+# сколько строк за раз считывать из курсора на стороне сервера при потоковой загрузке
+_YIELD_PER = 1000
+
+
+def _staging_table(model: type[MoodleBase], columns: t.Sequence[str]) -> TableClause:
+    """Возвращает описание временной таблицы, в которую копируются записи для указанной модели."""
+    return table(f'_staging_{model.__tablename__}', *(column(c) for c in columns))
+
+
+async def _stage_records(session: AsyncSession, model: type[MoodleBase], columns: t.Sequence[str],
+                         records: t.Union[t.Iterable[tuple], t.AsyncIterable[tuple]]) -> None:
+    """Копирует записи во временную таблицу с указанными столбцами модели, используя COPY (двоичный протокол asyncpg).
+    Временная таблица удаляется при завершении транзакции.
+    :param session: Сессия, в транзакции которой выполняется копирование.
+    :param model: Модель, чьи столбцы повторяет временная таблица.
+    :param columns: Имена копируемых столбцов, в порядке их следования в записях.
+    :param records: Копируемые записи (кортежи). Может быть асинхронным потоком, тогда записи копируются
+    по мере поступления."""
+    target = model.__tablename__
+    staging = _staging_table(model, columns).name
+    await session.execute(text(f'DROP TABLE IF EXISTS {staging}'))
+    await session.execute(text(f'CREATE TEMP TABLE {staging} ON COMMIT DROP AS '
+                               f'SELECT {", ".join(columns)} FROM {target} WITH NO DATA'))
+    conn = await session.connection()
+    raw = await conn.get_raw_connection()
+    await raw.driver_connection.copy_records_to_table(staging, records=records, columns=list(columns))
+
+
+def _not_staged(model: type[MoodleBase], keys: t.Sequence[str]) -> ColumnElement[bool]:
+    """Строит условие "записи с такими значениями ключевых столбцов нет во временной таблице" для запросов DELETE.
+    Временная таблица должна быть заполнена через _stage_records() в текущей транзакции."""
+    staged = _staging_table(model, keys)
+    target = model.__table__
+    return ~exists().where(*(staged.c[k] == target.c[k] for k in keys))
+
+
+def _any_id(col: ColumnElement[int], ids: t.Iterable[int]) -> ColumnElement[bool]:
+    """Строит условие "col = ANY($n)", передающее все ID одним параметром-массивом.
+    В отличие от col.in_(ids), текст запроса не зависит от числа ID, поэтому asyncpg переиспользует
+    подготовленный запрос из своего кэша."""
+    return col == any_(literal(list(ids), ARRAY(Integer)))
+
+
+def _any_id_param(col: ColumnElement[int], name: str) -> ColumnElement[bool]:
+    """Аналог _any_id() для заранее построенных запросов: массив ID передаётся при выполнении как параметр name."""
+    return col == any_(bindparam(name, type_=ARRAY(Integer)))
+
+
+@functools.cache
+def _open_course_ids_stmt(with_dates_only: bool) -> Select[tuple[int]]:
+    """Строит (однократно) запрос идентификаторов курсов, открытых в момент, переданный параметром now."""
+    now = bindparam('now', type_=MoodleCourse.starts.type)
+    stmt = select(MoodleCourse.id).select_from(MoodleCourse)
+    if with_dates_only:
+        return stmt.where(
+            and_(MoodleCourse.starts.isnot(None), MoodleCourse.starts <= now),
+            and_(MoodleCourse.ends.isnot(None), MoodleCourse.ends >= now),
+        )
+    else:
+        return stmt.where(
+            or_(MoodleCourse.starts.is_(None), MoodleCourse.starts <= now),
+            or_(MoodleCourse.ends.is_(None), MoodleCourse.ends >= now),
+        )
+
+
+@functools.cache
+def _load_assignments_stmt() -> Select:
+    """Строит (однократно) запрос заданий с ID из параметра-массива ids."""
+    return select(
+        MoodleAssignment.id,
+        MoodleAssignment.course_id,
+        MoodleAssignment.name,
+        MoodleAssignment.opening,
+        MoodleAssignment.closing,
+        MoodleAssignment.cutoff,
+    ).where(_any_id_param(MoodleAssignment.id, 'ids'))
+
+
+@functools.cache
+def _active_assignments_stmt() -> Select[tuple[int, bool]]:
+    """Строит (однократно) запрос ID открытых заданий из активных курсов вместе с признаком того,
+    что задание завершается в интервале между параметрами start и end. Текущий момент передаётся параметром now."""
+    now = bindparam('now', type_=MoodleAssignment.opening.type)
+    start = bindparam('start', type_=MoodleAssignment.closing.type)
+    end = bindparam('end', type_=MoodleAssignment.closing.type)
+    ending_soon = or_(  # хотя бы один из сроков должен попадать в интервал
+        # срок сдачи находится в интервале
+        and_(MoodleAssignment.closing.isnot(None),
+             MoodleAssignment.closing >= start,
+             MoodleAssignment.closing <= end),
+        # дата закрытия находится в интервале
+        and_(MoodleAssignment.cutoff.isnot(None),
+             MoodleAssignment.cutoff >= start,
+             MoodleAssignment.cutoff <= end),
+    )
+    return (
+        select(MoodleAssignment.id, ending_soon)
+        # выбираем только задания из активных курсов!
+        .join(MoodleCourse, onclause=and_(
+            (MoodleAssignment.course_id == MoodleCourse.id),
+            or_(MoodleCourse.starts.is_(None), MoodleCourse.starts <= now),
+            or_(MoodleCourse.ends.is_(None), MoodleCourse.ends >= now),
+        ))
+        # задание уже открыто
+        .where(or_(MoodleAssignment.opening.is_(None), MoodleAssignment.opening <= now))
+    )
+
+
+@functools.cache
+def _last_submission_times_stmt() -> Select[tuple[int, t.Optional[datetime]]]:
+    """Строит (однократно) запрос времени последнего ответа на задания с ID из параметра-массива ids.
+    Массив разворачивается в таблицу через unnest(), так что для заданий без ответов тоже вернётся строка (с NULL)."""
+    aids = (
+        func.unnest(bindparam('ids', type_=ARRAY(Integer)))
+        .table_valued(column('id', Integer))
+        .render_derived(name='aids')
+    )
+    return (
+        select(aids.c.id, func.max(MoodleSubmission.updated))
+        .select_from(aids)
+        .outerjoin(MoodleSubmission, onclause=MoodleSubmission.assignment_id == aids.c.id)
+        .group_by(aids.c.id)
+    )
+
+
+@functools.cache
+def _merge_staged(model: type[MoodleBase], columns: tuple[str, ...], update: tuple[str, ...] = ()) -> Insert:
+    """Строит (однократно для каждого набора аргументов) запрос, переносящий записи из временной таблицы в основную.
+    При конфликте по первичному ключу обновляет столбцы из update, а если их нет - пропускает запись."""
+    stmt = upsert(model).from_select(columns, select(_staging_table(model, columns)))
+    keys = list(model.__table__.primary_key)
+    if update:
+        return stmt.on_conflict_do_update(index_elements=keys, set_={c: stmt.excluded[c] for c in update})
+    return stmt.on_conflict_do_nothing(index_elements=keys)
+
+
+@functools.cache
+def _delete_for_courses(model: type[MoodleBase]) -> Delete:
+    """Строит (однократно) запрос, удаляющий все записи курсов с ID из параметра-массива cids."""
+    return delete(model).where(_any_id_param(model.__table__.c.course_id, 'cids'))
+
+
+@functools.cache
+def _merge_and_prune_staged(model: type[MoodleBase], columns: tuple[str, ...], update: tuple[str, ...],
+                            clear: tuple[type[MoodleBase], ...] = ()) -> Delete:
+    """Строит (однократно для каждого набора аргументов) запрос, который за одно обращение к БД переносит записи
+    из временной таблицы в основную (в CTE), и удаляет из основной таблицы записи курсов с ID из параметра-массива cids,
+    отсутствующие во временной. Из таблиц clear удаляются все записи этих курсов (тоже в CTE).
+    Удаление сверяется с временной таблицей по первичному ключу, так что ни одна строка не может быть одновременно
+    обновлена и удалена - иначе результат такого запроса был бы непредсказуем."""
+    keys = tuple(c.name for c in model.__table__.primary_key)
+    merge = _merge_staged(model, columns, update).cte(f'merged_{model.__tablename__}')
+    stmt = (
+        delete(model)
+        .where(_any_id_param(model.__table__.c.course_id, 'cids'), _not_staged(model, keys))
+        .add_cte(merge)
+    )
+    for other in clear:
+        stmt = stmt.add_cte(_delete_for_courses(other).cte(f'pruned_{other.__tablename__}'))
+    return stmt
+
+
+class _CourseRows(t.NamedTuple):
+    """Записи для всех таблиц, затрагиваемых при сохранении курсов. Словари индексированы первичными ключами."""
+    courses: dict[int, tuple]
+    users: dict[int, tuple]
+    roles: dict[int, tuple]
+    groups: dict[int, tuple]
+    participation: set[tuple[int, int]]
+    participant_roles: set[tuple[int, int, int]]
+    participant_groups: set[tuple[int, int, int]]
+
+
+def _collect_course_rows(courses: t.Iterable[Course], now: datetime) -> _CourseRows:
+    """Собирает записи для всех таблиц за один проход по курсам и их участникам.
+    Отметки времени курсов уже приведены к UTC адаптером Moodle, так что передаются в базу как есть."""
+    rows = _CourseRows({}, {}, {}, {}, set(), set(), set())
+    for c in courses:
+        cid = c.id
+        rows.courses[cid] = (cid, c.shortname, c.fullname, c.starts, c.ends, now)
+        for p in c.participants:
+            u = p.user
+            uid = u.id
+            rows.users[uid] = (uid, u.name, u.email, now)
+            rows.participation.add((cid, uid))
+            for r in p.roles:
+                rows.roles[r.id] = (r.id, r.name)
+                rows.participant_roles.add((cid, uid, r.id))
+            for g in p.groups:
+                rows.groups[g.id] = (g.id, cid, g.name)
+                rows.participant_groups.add((cid, uid, g.id))
+    return rows
+
+
+def _participants_digest(course: Course) -> bytes:
+    """Вычисляет отпечаток состава участников курса вместе с их ролями и группами.
+    Не зависит от порядка участников, ролей и групп."""
+    roster = sorted(
+        (p.user.id, sorted(r.id for r in p.roles), sorted(g.id for g in p.groups))
+        for p in course.participants
+    )
+    return hashlib.blake2b(repr(roster).encode(), digest_size=16).digest()
+
+
+# индексы, которые были в прежних версиях моделей, но стали избыточны: их заменили составные индексы,
+# начинающиеся с тех же столбцов. create_all() их не удалит, а каждая запись продолжала бы их обновлять
+_SUPERSEDED_INDEXES = (
+    'ix_moodle_submitted_files_assignment_id',  # ix_moodle_submitted_files_assignment_user_uploaded
+)
+
+
+def _create_missing_indexes(conn: Connection) -> None:
+    """Создаёт индексы, которых ещё нет в базе, и удаляет устаревшие.
+    create_all() не добавляет новые индексы к уже существующим таблицам и не удаляет старые."""
+    for name in _SUPERSEDED_INDEXES:
+        conn.execute(text(f'DROP INDEX IF EXISTS {name}'))
+    for tbl in MoodleBase.metadata.sorted_tables:
+        for index in tbl.indexes:
+            index.create(conn, checkfirst=True)
+
+
 # noinspection PyMethodMayBeStatic
 class MoodleRepository:
-    """Предоставляет услуги по чтению и записи локального кэша сущностей Moodle."""
+    """Предоставляет услуги по чтению и записи локального кэша сущностей Moodle.
+
+    Предполагается, что таблицы участников курсов (MoodleParticipant*) изменяет только этот экземпляр:
+    отпечатки записанного состава участников хранятся в памяти процесса, и курсы с неизменным отпечатком
+    не перезаписываются. Если эти таблицы изменены в обход репозитория (или БД восстановлена из копии),
+    следует вызвать forget_participant_digests(), чтобы при следующем опросе состав был записан заново."""
     TZ = timezone.utc
+    OPEN_COURSES_TTL = 30.0
 
     def __init__(self, engine: AsyncEngine, log: logging.Logger):
+        # простые запросы идентификаторов выполняются прямо через соединение, минуя ORM-сессию
+        self.__engine = engine
         self.__sessionmaker = async_sessionmaker(bind=engine, class_=AsyncSession,
                                                  autoflush=True, expire_on_commit=False)
         self.__log = log
+        # кэш открытых курсов: (минута, with_dates_only) -> (когда получен по time.monotonic(), ID курсов).
+        # даты курсов меняются редко, а опрашиваются часто, так что кэш сбрасывается только при изменении курсов
+        self.__open_cache: dict[tuple[int, bool], tuple[float, list[course_id]]] = {}
+        # отпечатки состава участников, записанного в БД: course_id -> _participants_digest().
+        # курсы опрашиваются постоянно, а состав меняется редко, так что участники курсов с тем же отпечатком
+        # повторно не сохраняются. обновляется только после успешной фиксации транзакции
+        self.__rosters: dict[int, bytes] = {}
 
     async def create_tables(self) -> None:
         """Создаёт таблицы, необходимые для работы репозитория."""
-        engine: AsyncEngine = self.__sessionmaker.kw['bind']
-        async with engine.connect() as conn:
+        async with self.__engine.connect() as conn:
             await conn.run_sync(MoodleBase.metadata.create_all)
+            await conn.run_sync(_create_missing_indexes)
             await conn.commit()
 
     # region Курсы
+    def forget_participant_digests(self) -> None:
+        """Сбрасывает отпечатки состава участников, так что следующее сохранение курсов
+        перезапишет участников всех курсов, даже если их состав не изменился."""
+        self.__rosters.clear()
+
     async def load_courses(self, course_ids: t.Collection[course_id]) -> list[Course]:
-        """Загружает список курсов с указанными id.
+        """Загружает список курсов с указанными id одним запросом: участники курса, их роли и группы
+        собираются во вложенные JSON-массивы на стороне БД.
         :param course_ids: Коллекция идентификаторов курсов.
         :returns: Список объектов Course."""
         if not course_ids:
             return []
-        participants: dict[int, dict[int, tuple[str, str, list[Role], list[Group]]]] = defaultdict(dict)
+        # роли и группы каждого участника собираются в JSON-массивы прямо в БД
+        roles = (
+            select(func.json_agg(func.json_build_array(MoodleRole.id, MoodleRole.name)))
+            .select_from(MoodleParticipantRoles)
+            .join(MoodleRole, onclause=MoodleParticipantRoles.role_id == MoodleRole.id)
+            .where(MoodleParticipantRoles.course_id == MoodleParticipant.course_id,
+                   MoodleParticipantRoles.user_id == MoodleParticipant.user_id)
+            .scalar_subquery()
+        )
+        groups = (
+            select(func.json_agg(func.json_build_array(MoodleGroup.id, MoodleGroup.name)))
+            .select_from(MoodleParticipantGroups)
+            .join(MoodleGroup, onclause=MoodleParticipantGroups.group_id == MoodleGroup.id)
+            .where(MoodleParticipantGroups.course_id == MoodleParticipant.course_id,
+                   MoodleParticipantGroups.user_id == MoodleParticipant.user_id)
+            .scalar_subquery()
+        )
+        # а участники - в JSON-массив для каждого курса
+        participants = (
+            select(func.json_agg(func.json_build_array(
+                MoodleUser.id, MoodleUser.fullname, MoodleUser.email, roles, groups), type_=JSON))
+            .select_from(MoodleParticipant)
+            .join(MoodleUser, onclause=MoodleUser.id == MoodleParticipant.user_id)
+            .where(MoodleParticipant.course_id == MoodleCourse.id)
+            .scalar_subquery()
+        )
+        stmt = (
+            select(MoodleCourse.id, MoodleCourse.fullname, MoodleCourse.shortname,
+                   MoodleCourse.starts, MoodleCourse.ends, participants)
+            .where(_any_id(MoodleCourse.id, course_ids))
+            .execution_options(yield_per=_YIELD_PER)
+        )
         async with self.__sessionmaker() as session:
-            # загружаем пользователей курсов
-            stmt = (
-                select(
-                    MoodleParticipant.course_id,
-                    MoodleUser.id, MoodleUser.fullname, MoodleUser.email
-                )
-                .select_from(MoodleParticipant)
-                .join(MoodleUser, onclause=MoodleUser.id == MoodleParticipant.user_id)
-                .where(MoodleParticipant.course_id.in_(course_ids))
-            )
-            async for cid, uid, uname, uemail in await session.stream(stmt):
-                participants[cid][uid] = (uname, uemail, [], [])
-            # загружаем роли пользователей
-            stmt = (
-                select(
-                    MoodleParticipantRoles.course_id, MoodleParticipantRoles.user_id,
-                    MoodleRole.id, MoodleRole.name
-                )
-                .select_from(MoodleParticipantRoles)
-                .join(MoodleRole, onclause=MoodleParticipantRoles.role_id == MoodleRole.id)
-                .where(MoodleParticipantRoles.course_id.in_(course_ids))
-            )
-            async for cid, uid, rid, rname in await session.stream(stmt):
-                p = participants[cid].get(uid, None)
-                if p is not None:
-                    p[2].append(Role(rid, rname))
-            # загружаем группы пользователей
-            stmt = (
-                select(
-                    MoodleParticipantGroups.course_id, MoodleParticipantGroups.user_id,
-                    MoodleGroup.id, MoodleGroup.name
-                )
-                .select_from(MoodleParticipantGroups)
-                .join(MoodleGroup, onclause=MoodleParticipantGroups.group_id == MoodleGroup.id)
-                .where(MoodleParticipantGroups.course_id.in_(course_ids))
-            )
-            async for cid, uid, gid, gname in await session.stream(stmt):
-                p = participants[cid].get(uid, None)
-                if p is not None:
-                    p[3].append(Group(rid, rname))
-            # загружаем курсы
-            stmt = (
-                select(MoodleCourse.id, MoodleCourse.fullname, MoodleCourse.shortname,
-                       MoodleCourse.starts, MoodleCourse.ends)
-                .select_from(MoodleCourse)
-                .where(MoodleCourse.id.in_(course_ids))
-            )
-            courses: list[Course] = []
-            async for cid, cfull, cshort, cstart, cend in await session.stream(stmt):
-                parts = [
-                    Participant(user=User(id=user_id(uid), name=uname, email=uemail),
-                                roles=tuple(uroles), groups=tuple(ugroups))
-                    for uid, (uname, uemail, uroles, ugroups) in participants[cid].items()
-                ]
-                course = Course(
+            # пустые подзапросы json_agg() возвращают NULL, а не пустой массив.
+            # пары [id, name] совпадают по порядку с полями Role и Group, так что создаём их через starmap
+            return [
+                Course(
                     id=course_id(cid),
                     shortname=cshort,
                     fullname=cfull,
-                    participants=tuple(parts),
+                    participants=tuple(
+                        Participant(user=User(id=user_id(uid), name=uname, email=uemail),
+                                    roles=tuple(itertools.starmap(Role, uroles or ())),
+                                    groups=tuple(itertools.starmap(Group, ugroups or ())))
+                        for uid, uname, uemail, uroles, ugroups in cparts or ()
+                    ),
                     starts=cstart,
                     ends=cend
                 )
-                courses.append(course)
-        return courses
+                async for cid, cfull, cshort, cstart, cend, cparts in await session.stream(stmt)
+            ]
 
-    async def _store_roles_for(self, session: AsyncSession, courses: t.Collection[Course]) -> None:
-        """Сохраняет роли, встреченные в указанных курсах."""
-        all_roles = set(r for c in courses for p in c.participants for r in p.roles)
-        if not all_roles:
+    async def _store_course_rows(self, session: AsyncSession, courses: t.Collection[tuple]) -> None:
+        """Сохраняет сами курсы.
+        :param courses: Записи (id, shortname, fullname, starts, ends, last_seen) без повторов."""
+        columns = ('id', 'shortname', 'fullname', 'starts', 'ends', 'last_seen')
+        await _stage_records(session, MoodleCourse, columns, courses)
+        await session.execute(_merge_staged(MoodleCourse, columns, columns[1:]))
+
+    async def _store_roles(self, session: AsyncSession, roles: t.Collection[tuple]) -> None:
+        """Сохраняет роли, встреченные в курсах.
+        :param roles: Записи (id, name) без повторов."""
+        if not roles:
             return
-        stmt = upsert(MoodleRole)
-        stmt = stmt.on_conflict_do_update(index_elements=[MoodleRole.id], set_={
-            MoodleRole.name: stmt.excluded.name
-        })
-        await session.execute(
-            stmt,
-            [{'id': r.id, 'name': r.name} for r in all_roles]
-        )
-        await session.commit()
+        columns = ('id', 'name')
+        await _stage_records(session, MoodleRole, columns, roles)
+        await session.execute(_merge_staged(MoodleRole, columns, ('name',)))
 
-    async def _store_groups_for(self, session: AsyncSession, courses: t.Collection[Course]) -> None:
+    async def _store_groups_for(self, session: AsyncSession, cids: t.Collection[int],
+                                groups: t.Collection[tuple]) -> None:
         """Сохраняет группы, встреченные в указанных курсах.
-        Если группа, связанная с курсом, есть в БД, но не упоминается в курсе, она будет удалена из БД."""
-        cids = set(c.id for c in courses)
-        groups = set((c.id, g) for c in courses for p in c.participants for g in p.groups)
+        Если группа, связанная с курсом, есть в БД, но не упоминается в курсе, она будет удалена из БД.
+        :param cids: ID курсов, группы которых сохраняются.
+        :param groups: Записи (id, course_id, name) без повторов."""
         if not groups:
             return
-        stmt = upsert(MoodleGroup)
-        stmt = stmt.on_conflict_do_update(index_elements=[MoodleGroup.id], set_={
-            MoodleGroup.course_id: stmt.excluded.course_id,
-            MoodleGroup.name: stmt.excluded.name
-        })
-        await session.execute(
-            stmt,
-            [{'id': g.id, 'name': g.name, 'course_id': cid} for cid, g in groups]
-        )
-        course_groups = set((cid, g.id) for cid, g in groups)
-        stmt = delete(MoodleGroup).where(
-            MoodleGroup.course_id.in_(cids),
-            tuple_(MoodleGroup.course_id, MoodleGroup.id).notin_(course_groups))
-        await session.execute(stmt)
-        await session.commit()
-
-    async def _store_participants_for(self, session: AsyncSession, courses: t.Collection[Course]) -> None:
-        """Сохраняет участников указанных курсов, их роли и группы."""
-        cids = set(c.id for c in courses)
-        participation = set((c.id, p.user.id) for c in courses for p in c.participants)
-        if participation:
-            stmt = upsert(MoodleParticipant)
-            stmt = stmt.on_conflict_do_nothing(
-                index_elements=[MoodleParticipant.course_id, MoodleParticipant.user_id]
-            )
-            await session.execute(stmt, [
-                {'course_id': cid, 'user_id': uid}
-                for cid, uid in participation
-            ])
-        stmt = delete(MoodleParticipant).where(MoodleParticipant.course_id.in_(cids))
-        if participation:
-            stmt = stmt.where(tuple_(MoodleParticipant.course_id, MoodleParticipant.user_id).notin_(participation))
-        await session.execute(stmt)
-
-        participant_roles = set((c.id, p.user.id, r.id) for c in courses for p in c.participants for r in p.roles)
-        if participant_roles:
-            stmt = upsert(MoodleParticipantRoles)
-            stmt = stmt.on_conflict_do_nothing(
-                index_elements=[MoodleParticipantRoles.course_id, MoodleParticipantRoles.user_id,
-                                MoodleParticipantRoles.role_id]
-            )
-            await session.execute(stmt, [
-                {'course_id': cid, 'user_id': uid, 'role_id': rid}
-                for cid, uid, rid in participant_roles
-            ])
-        stmt = delete(MoodleParticipantRoles).where(MoodleParticipantRoles.course_id.in_(cids))
+        columns = ('id', 'course_id', 'name')
+        await _stage_records(session, MoodleGroup, columns, groups)
+        await session.execute(_merge_and_prune_staged(MoodleGroup, columns, ('course_id', 'name')),
+                              {'cids': list(cids)})
+
+    async def _store_participants_for(self, session: AsyncSession, cids: t.Collection[int],
+                                      participation: t.Collection[tuple[int, int]],
+                                      participant_roles: t.Collection[tuple[int, int, int]],
+                                      participant_groups: t.Collection[tuple[int, int, int]]) -> None:
+        """Сохраняет участников указанных курсов, их роли и группы.
+        :param cids: ID курсов, участники которых сохраняются.
+        :param participation: Пары (course_id, user_id).
+        :param participant_roles: Тройки (course_id, user_id, role_id).
+        :param participant_groups: Тройки (course_id, user_id, group_id)."""
+        params = {'cids': list(cids)}
+        if not participation:
+            # роли и группы участников удалятся вместе с ними по каскаду
+            await session.execute(_delete_for_courses(MoodleParticipant), params)
+            return
+        columns = ('course_id', 'user_id')
+        await _stage_records(session, MoodleParticipant, columns, participation)
+        # если ролей или групп у участников нет, их удаление выполняется тем же запросом, что и участников
+        clear = tuple(model for model, rows in ((MoodleParticipantRoles, participant_roles),
+                                                (MoodleParticipantGroups, participant_groups)) if not rows)
+        await session.execute(_merge_and_prune_staged(MoodleParticipant, columns, (), clear), params)
+
         if participant_roles:
-            stmt = stmt.where(tuple_(
-                MoodleParticipantRoles.course_id,
-                MoodleParticipantRoles.user_id,
-                MoodleParticipantRoles.role_id
-            ).notin_(participant_roles))
-        await session.execute(stmt)
-
-        participant_groups = set((c.id, p.user.id, g.id) for c in courses for p in c.participants for g in p.groups)
-        if participant_groups:
-            stmt = upsert(MoodleParticipantGroups)
-            stmt = stmt.on_conflict_do_nothing(
-                index_elements=[MoodleParticipantGroups.course_id, MoodleParticipantGroups.user_id,
-                                MoodleParticipantGroups.group_id]
-            )
-            await session.execute(stmt, [
-                {'course_id': cid, 'user_id': uid, 'group_id': gid}
-                for cid, uid, gid in participant_groups
-            ])
-        stmt = delete(MoodleParticipantGroups).where(MoodleParticipantGroups.course_id.in_(cids))
+            columns = ('course_id', 'user_id', 'role_id')
+            await _stage_records(session, MoodleParticipantRoles, columns, participant_roles)
+            await session.execute(_merge_and_prune_staged(MoodleParticipantRoles, columns, ()), params)
+
         if participant_groups:
-            stmt = stmt.where(tuple_(
-                MoodleParticipantGroups.course_id,
-                MoodleParticipantGroups.user_id,
-                MoodleParticipantGroups.group_id
-            ).notin_(participant_groups))
-        await session.execute(stmt)
-        await session.commit()
-
-    async def _store_users(self, session: AsyncSession, courses: t.Collection[Course],
-                           now: t.Optional[datetime]) -> None:
-        """Сохраняет пользователей, упомянутых на разных курсах."""
-        data = set(p for c in courses for p in c.participants)
-        if not data:
+            columns = ('course_id', 'user_id', 'group_id')
+            await _stage_records(session, MoodleParticipantGroups, columns, participant_groups)
+            await session.execute(_merge_and_prune_staged(MoodleParticipantGroups, columns, ()), params)
+
+    async def _store_users(self, session: AsyncSession, users: t.Collection[tuple]) -> None:
+        """Сохраняет пользователей, упомянутых на разных курсах.
+        :param users: Записи (id, fullname, email, last_seen) без повторов."""
+        if not users:
             return
-        stmt = upsert(MoodleUser)
-        stmt = stmt.on_conflict_do_update(
-            index_elements=[MoodleUser.id],
-            set_={
-                MoodleUser.fullname: stmt.excluded.fullname,
-                MoodleUser.email: stmt.excluded.email,
-                MoodleUser.last_seen: stmt.excluded.last_seen
-            }
-        )
-        await session.execute(stmt, [
-            dict(id=p.user.id, fullname=p.user.name, email=p.user.email, last_seen=now)
-            for p in data
-        ])
-        await session.commit()
+        columns = ('id', 'fullname', 'email', 'last_seen')
+        await _stage_records(session, MoodleUser, columns, users)
+        await session.execute(_merge_staged(MoodleUser, columns, ('fullname', 'email', 'last_seen')))
+
+    async def _store_course_batch(self, session: AsyncSession, courses: t.Collection[Course],
+                                  now: datetime) -> dict[int, bytes]:
+        """Сохраняет пакет курсов в рамках переданной транзакции.
+        Данные копируются во временные таблицы (COPY), а затем переносятся в основные одним запросом на таблицу.
+        Запросы выполняются строго по порядку: курсы и пользователи, затем роли и группы, затем участники.
+        Участники сохраняются только для курсов, состав которых изменился с прошлого сохранения.
+        :returns: Новые отпечатки состава участников сохранённых курсов - их следует запомнить после фиксации."""
+        if not courses:
+            return {}
+        rows = _collect_course_rows(courses, now)
+        cids = list(rows.courses)
+        await self._store_course_rows(session, rows.courses.values())
+        await self._store_users(session, rows.users.values())
+        await self._store_roles(session, rows.roles.values())
+        await self._store_groups_for(session, cids, rows.groups.values())
+        rosters = {c.id: _participants_digest(c) for c in courses}
+        changed = {cid for cid, digest in rosters.items() if self.__rosters.get(cid) != digest}
+        if changed:
+            await self._store_participants_for(
+                session, changed,
+                [r for r in rows.participation if r[0] in changed],
+                [r for r in rows.participant_roles if r[0] in changed],
+                [r for r in rows.participant_groups if r[0] in changed])
+        return {cid: rosters[cid] for cid in changed}
 
     async def store_courses(self, courses: t.Collection[Course], now: datetime = None) -> None:
         """Сохраняет записи о курсах в БД.
+        Все изменения выполняются в одной транзакции. При ошибке транзакция откатывается целиком.
         :param courses: Коллекция курсов для сохранения.
         :param now: Время для пометки сохраняемых курсов (когда их в последний раз "видели").
         Если None, используется текущее время."""
-        courses = set(courses)
         if not courses:
             return
         now = now.astimezone(self.TZ) if now is not None else datetime.now(self.TZ)
-        async with self.__sessionmaker() as session:
-            data = [
-                dict(id=c.id, shortname=c.shortname, fullname=c.fullname,
-                     starts=c.starts.astimezone(self.TZ) if c.starts else None,
-                     ends=c.ends.astimezone(self.TZ) if c.ends else None,
-                     last_seen=now)
-                for c in courses
-            ]
-            stmt = upsert(MoodleCourse)
-            stmt = stmt.on_conflict_do_update(
-                index_elements=[MoodleCourse.id],
-                set_={
-                    MoodleCourse.shortname: stmt.excluded.shortname,
-                    MoodleCourse.fullname: stmt.excluded.fullname,
-                    MoodleCourse.starts: stmt.excluded.starts,
-                    MoodleCourse.ends: stmt.excluded.ends,
-                    MoodleCourse.last_seen: stmt.excluded.last_seen,
-                }
-            )
-            await session.execute(stmt, data)
-            await session.commit()
+        async with self.__sessionmaker.begin() as session:
+            rosters = await self._store_course_batch(session, courses, now)
+        self.__rosters.update(rosters)
+        self.__open_cache.clear()
 
-            await self._store_users(session, courses, now)
-            await self._store_roles_for(session, courses)
-            await self._store_groups_for(session, courses)
-            await self._store_participants_for(session, courses)
-            await session.commit()
+    async def store_course_batches(self, batches: t.AsyncIterable[t.Collection[Course]], now: datetime = None) -> None:
+        """Сохраняет записи о курсах, поступающие пакетами из асинхронного потока.
+        Все пакеты сохраняются в одной общей транзакции, так что при ошибке не останется частично обновлённых данных.
+        :param batches: Поток пакетов курсов для сохранения.
+        :param now: Время для пометки сохраняемых курсов (когда их в последний раз "видели").
+        Если None, используется текущее время."""
+        now = now.astimezone(self.TZ) if now is not None else datetime.now(self.TZ)
+        rosters: dict[int, bytes] = {}
+        async with self.__sessionmaker.begin() as session:
+            async for courses in batches:
+                rosters.update(await self._store_course_batch(session, courses, now))
+        self.__rosters.update(rosters)
+        self.__open_cache.clear()
 
     async def drop_courses(self, course_ids: t.Collection[int]) -> None:
         """Удаляет из базы записи о курсах с указанными id.
         :param course_ids: Коллекция идентификаторов удаляемых курсов."""
         if not course_ids:
             return
+        for cid in course_ids:
+            self.__rosters.pop(cid, None)
         async with self.__sessionmaker() as session:
-            stmt = delete(MoodleCourse).where(MoodleCourse.id.in_(course_ids))
+            stmt = delete(MoodleCourse).where(_any_id(MoodleCourse.id, course_ids))
             await session.execute(stmt)
             await session.commit()
+        self.__open_cache.clear()
 
     async def get_open_course_ids(self, now: datetime, with_dates_only: bool = False) -> list[course_id]:
         """Возвращает идентификаторы курсов, которые открыты в настоящий момент.
         :param now: Что считать настоящим моментом.
         :param with_dates_only: Если истина, то курсы, для которых не указаны даты начала/конца, будут игнорироваться.
+        Результат кэшируется на OPEN_COURSES_TTL секунд с точностью до минуты.
         :returns: Список идентификаторов."""
-        now = now.astimezone(self.TZ)
+        key = (int(now.timestamp()) // 60, with_dates_only)
+        cached = self.__open_cache.get(key)
+        if cached is not None and time.monotonic() - cached[0] < self.OPEN_COURSES_TTL:
+            return list(cached[1])
+        async with self.__engine.connect() as conn:
+            result = await conn.scalars(_open_course_ids_stmt(with_dates_only), {'now': now.astimezone(self.TZ)})
+            # course_id - это NewType, так что оборачивать каждое значение не нужно
+            ids = t.cast(list[course_id], result.all())
+        # записи за другие минуты больше не понадобятся
+        self.__open_cache = {k: v for k, v in self.__open_cache.items() if k[0] == key[0]}
+        self.__open_cache[key] = time.monotonic(), ids
+        return list(ids)
+
+    async def iter_open_course_ids(self, now: datetime, with_dates_only: bool = False,
+                                   batch_size: int = 1000) -> t.AsyncIterator[course_id]:
+        """Перебирает идентификаторы курсов, которые открыты в настоящий момент, не загружая их все в память сразу.
+        Строки читаются через курсор на стороне сервера пакетами по batch_size штук.
+        :param now: Что считать настоящим моментом.
+        :param with_dates_only: Если истина, то курсы, для которых не указаны даты начала/конца, будут игнорироваться.
+        :param batch_size: Сколько строк загружать из курсора за раз."""
+        stmt = _open_course_ids_stmt(with_dates_only).execution_options(yield_per=batch_size)
         async with self.__sessionmaker() as session:
-            stmt = (
-                select(MoodleCourse.id)
-                .select_from(MoodleCourse)
-            )
-            if with_dates_only:
-                stmt = stmt.where(
-                    and_(MoodleCourse.starts.isnot(None), MoodleCourse.starts <= now),
-                    and_(MoodleCourse.ends.isnot(None), MoodleCourse.ends >= now),
-                )
-            else:
-                stmt = stmt.where(
-                    or_(MoodleCourse.starts.is_(None), MoodleCourse.starts <= now),
-                    or_(MoodleCourse.ends.is_(None), MoodleCourse.ends >= now),
-                )
-            result = await session.execute(stmt)
-            return [course_id(cid) for cid in result.scalars().all()]
+            async for cid in await session.stream_scalars(stmt, {'now': now.astimezone(self.TZ)}):
+                yield cid
     # endregion
 
     # region Задания
@@ -308,21 +518,11 @@ class MoodleRepository:
         :returns: Список заданий (Assignment)."""
         if not assign_ids:
             return []
-        async with self.__sessionmaker() as session:
-            stmt = select(
-                MoodleAssignment.id,
-                MoodleAssignment.course_id,
-                MoodleAssignment.name,
-                MoodleAssignment.opening,
-                MoodleAssignment.closing,
-                MoodleAssignment.cutoff,
-            ).where(MoodleAssignment.id.in_(assign_ids))
-            result = await session.stream(stmt)
-            results = [
-                Assignment(id=aid, course_id=cid, name=aname, opening=aopen, closing=aclose, cutoff=acutoff)
-                async for (aid, cid, aname, aopen, aclose, acutoff) in result
-            ]
-        return results
+        # заданий в одном запросе немного, так что серверный курсор не нужен - строки читаются сразу целиком.
+        # порядок столбцов совпадает с порядком полей Assignment, так что строки передаются ему позиционно
+        async with self.__engine.connect() as conn:
+            result = await conn.execute(_load_assignments_stmt(), {'ids': list(assign_ids)})
+            return list(itertools.starmap(Assignment, result.tuples()))
 
     async def store_assignments(self, assigns: t.Collection[Assignment]) -> None:
         """Сохраняет задания в базу данных, обновляя уже существующие записи, если надо.
@@ -330,117 +530,65 @@ class MoodleRepository:
         assigns = set(assigns)
         if not assigns:
             return
-        data = [dict(id=a.id, course_id=a.course_id, name=a.name,
-                     opening=a.opening.astimezone(self.TZ) if a.opening else None,
-                     closing=a.closing.astimezone(self.TZ) if a.closing else None,
-                     cutoff=a.cutoff.astimezone(self.TZ) if a.cutoff else None)
-                for a in assigns]
-        async with self.__sessionmaker() as session:
-            stmt = upsert(MoodleAssignment)
-            stmt = stmt.on_conflict_do_update(
-                index_elements=[MoodleAssignment.id],
-                set_={
-                    MoodleAssignment.course_id: stmt.excluded.course_id,
-                    MoodleAssignment.name: stmt.excluded.name,
-                    MoodleAssignment.opening: stmt.excluded.opening,
-                    MoodleAssignment.closing: stmt.excluded.closing,
-                    MoodleAssignment.cutoff: stmt.excluded.cutoff,
-                }
-            )
-            await session.execute(stmt, data)
-            await session.commit()
+        columns = ('id', 'course_id', 'name', 'opening', 'closing', 'cutoff')
+        async with self.__sessionmaker.begin() as session:
+            await _stage_records(session, MoodleAssignment, columns, list(map(operator.attrgetter(*columns), assigns)))
+            await session.execute(_merge_staged(MoodleAssignment, columns, columns[1:]))
+
+    async def store_assignment_stream(self, assigns: t.AsyncIterable[Assignment]) -> None:
+        """Сохраняет задания из асинхронного потока, обновляя уже существующие записи, если надо.
+        Задания копируются во временную таблицу (COPY) по мере поступления из потока,
+        и переносятся в основную таблицу одним запросом после его завершения.
+        :param assigns: Поток сохраняемых заданий."""
+        columns = ('id', 'course_id', 'name', 'opening', 'closing', 'cutoff')
+        get_row = operator.attrgetter(*columns)
+
+        async def records() -> t.AsyncIterable[tuple]:
+            seen = set()
+            async for a in assigns:
+                if a.id in seen:
+                    continue
+                seen.add(a.id)
+                yield get_row(a)
+
+        async with self.__sessionmaker.begin() as session:
+            await _stage_records(session, MoodleAssignment, columns, records())
+            await session.execute(_merge_staged(MoodleAssignment, columns, columns[1:]))
 
     async def drop_assignments_except_for(self, content: dict[course_id, t.Collection[assignment_id]]) -> None:
         """Удаляет из базы все задания для указанных курсов, за исключением перечисленных.
         Курсы, чьи ID отсутствуют среди ключей content, не будут затронуты.
         :param content: Набор пар "ID курса - список ID заданий", которые следует оставить."""
         affected_cids = list(content.keys())
-        correct_pairs = [(cid, aid) for cid, aids in content.items() for aid in aids]
-        async with self.__sessionmaker() as session:
-            stmt = delete(MoodleAssignment).where(MoodleAssignment.course_id.in_(affected_cids))
-            if correct_pairs:
-                stmt = stmt.where(tuple_(MoodleAssignment.course_id, MoodleAssignment.id).notin_(correct_pairs))
+        # ID заданий уникальны в рамках сервера, так что сверять пары (курс, задание) не нужно:
+        # списка оставляемых ID, переданного одним параметром-массивом, достаточно, и удаление обходится
+        # одним запросом без временной таблицы
+        correct_ids = [aid for aids in content.values() for aid in aids]
+        async with self.__sessionmaker.begin() as session:
+            stmt = delete(MoodleAssignment).where(_any_id(MoodleAssignment.course_id, affected_cids))
+            if correct_ids:
+                stmt = stmt.where(~_any_id(MoodleAssignment.id, correct_ids))
             await session.execute(stmt)
-            await session.commit()
 
-    async def get_active_assignment_ids_ending_soon(self, now: datetime, *,
+    async def get_active_assignment_ids_partitioned(self, now: datetime, *,
                                                     before: timedelta, after: timedelta
-                                                    ) -> list[assignment_id]:
-        """Загружает список ID заданий, которые завершаются (срок сдачи или закрытие) в указанный интервал времени.
-        Задания, для которых не указано время закрытия, никогда не попадут в этот список.
-        :param now: Текущий момент времени (внутри интервала).
-        :param before: Отступ от начала интервала до текущего момента.
-        :param after: Отступ от текущего момента до конца интервала.
-        :returns: Список ID заданий, удовлетворяющих условиям."""
-        now = now.astimezone(self.TZ)
-        start = now - before
-        end = now + after
-        async with self.__sessionmaker() as session:
-            stmt = (
-                select(MoodleAssignment.id)
-                # выбираем только задания из активных курсов!
-                .join(MoodleCourse, onclause=and_(
-                    (MoodleAssignment.course_id == MoodleCourse.id),
-                    or_(MoodleCourse.starts.is_(None), MoodleCourse.starts <= now),
-                    or_(MoodleCourse.ends.is_(None), MoodleCourse.ends >= now),
-                ))
-                .where(
-                    # задание уже открыто
-                    or_(MoodleAssignment.opening.is_(None), MoodleAssignment.opening <= now),
-                    or_(  # хотя бы один из сроков должен попадать в интервал
-                        # срок сдачи находится в интервале
-                        and_(MoodleAssignment.closing.isnot(None),
-                             start <= MoodleAssignment.closing,
-                             MoodleAssignment.closing <= end),
-                        # дата закрытия находится в интервале
-                        and_(MoodleAssignment.cutoff.isnot(None),
-                             start <= MoodleAssignment.cutoff,
-                             MoodleAssignment.cutoff <= end),
-                    ),
-                )
-            )
-            result = await session.scalars(stmt)
-            return [assignment_id(aid) for aid in result.all()]
-
-    async def get_active_assignment_ids_not_ending_soon(self, now: datetime, *,
-                                                        before: timedelta, after: timedelta
-                                                        ) -> list[assignment_id]:
-        """Загружает список ID заданий, которые уже открыты, но НЕ завершаются (срок сдачи или закрытие)
-        в указанный интервал времени. Задания, для которых не указано время закрытия, всегда попадут в этот список.
+                                                    ) -> tuple[list[assignment_id], list[assignment_id]]:
+        """Загружает ID открытых заданий из активных курсов и делит их на две группы одним запросом:
+        те, что завершаются (срок сдачи или закрытие) в указанный интервал времени, и все остальные.
+        Задания, для которых не указано время закрытия, всегда попадут во вторую группу.
         Если курс ещё не доступен или уже не доступен, его задания игнорируются.
         :param now: Текущий момент времени (внутри интервала).
         :param before: Отступ от начала интервала до текущего момента.
         :param after: Отступ от текущего момента до конца интервала.
-        :returns: Список ID заданий, удовлетворяющих условиям."""
+        :returns: Пара списков ID заданий: (завершающиеся в интервале, не завершающиеся в интервале)."""
         now = now.astimezone(self.TZ)
-        start = now - before
-        end = now + after
-        async with self.__sessionmaker() as session:
-            stmt = (
-                select(MoodleAssignment.id)
-                # выбираем только задания из активных курсов!
-                .join(MoodleCourse, onclause=and_(
-                    (MoodleAssignment.course_id == MoodleCourse.id),
-                    or_(MoodleCourse.starts.is_(None), MoodleCourse.starts <= now),
-                    or_(MoodleCourse.ends.is_(None), MoodleCourse.ends >= now),
-                ))
-                .where(
-                    # задание уже открыто
-                    or_(MoodleAssignment.opening.is_(None), MoodleAssignment.opening <= now),
-                    and_(  # ни один из сроков не должен попадать в интервал
-                        # срок сдачи неизвестен или не находится в интервале
-                        or_(MoodleAssignment.closing.is_(None),
-                            start > MoodleAssignment.closing,
-                            MoodleAssignment.closing > end),
-                        # дата закрытия неизвестна или не находится в интервале
-                        or_(MoodleAssignment.cutoff.is_(None),
-                            start > MoodleAssignment.cutoff,
-                            MoodleAssignment.cutoff > end),
-                    ),
-                )
-            )
-            result = await session.scalars(stmt)
-            return [assignment_id(aid) for aid in result.all()]
+        params = {'now': now, 'start': now - before, 'end': now + after}
+        async with self.__engine.connect() as conn:
+            ending: list[assignment_id] = []
+            not_ending: list[assignment_id] = []
+            for aid, is_ending in (await conn.execute(_active_assignments_stmt(), params)).all():
+                (ending if is_ending else not_ending).append(aid)
+            return ending, not_ending
     # endregion
 
     # region Ответы на задания
@@ -451,99 +599,81 @@ class MoodleRepository:
         :param before: Самый ранний момент времени, в который могли быть отправлены ответы.
         :param after: Самый поздний момент времени, в который могли быть отправлены ответы.
         :returns: Список ответов."""
-        async with self.__sessionmaker() as session:
-            stmt = (
-                select(
-                    MoodleSubmission.id, MoodleSubmission.user_id, MoodleSubmission.status, MoodleSubmission.updated
-                ).select_from(MoodleSubmission)
-                .where(MoodleSubmission.assignment_id == assignid)
-            )
-            if before:
-                stmt = stmt.where(MoodleSubmission.updated <= before.astimezone(self.TZ))
-            if after:
-                stmt = stmt.where(MoodleSubmission.updated >= after.astimezone(self.TZ))
-            result = await session.stream(stmt)
-            raw_subs = {
-                sid: (uid, status, updated, [])
-                async for (sid, uid, status, updated) in result
-            }
-            if not raw_subs:
-                return []
-            stmt = (
-                select(
-                    MoodleSubmittedFile.submission_id, MoodleSubmittedFile.filename, MoodleSubmittedFile.url,
-                    MoodleSubmittedFile.filesize, MoodleSubmittedFile.mimetype, MoodleSubmittedFile.uploaded
-                ).select_from(MoodleSubmittedFile)
-                .where(
-                    MoodleSubmittedFile.assignment_id == assignid,
-                    MoodleSubmittedFile.submission_id.in_(raw_subs.keys())
-                )
-            )
-            result = await session.stream(stmt)
-            async for (sid, fname, furl, fsize, ftype, fupload) in result:
-                raw_subs[sid][3].append(SubmittedFile(
-                    submission_id=sid,
-                    filename=fname,
-                    mimetype=ftype,
-                    filesize=fsize,
-                    url=furl,
-                    uploaded=fupload
+        conditions = [MoodleSubmission.assignment_id == assignid]
+        if before:
+            conditions.append(MoodleSubmission.updated <= before.astimezone(self.TZ))
+        if after:
+            conditions.append(MoodleSubmission.updated >= after.astimezone(self.TZ))
+        # файлы каждого ответа собираются в JSON-массив прямо в БД, так что всё загружается одним запросом.
+        # порядок элементов совпадает с порядком полей SubmittedFile (кроме submission_id)
+        files = (
+            select(func.json_agg(func.json_build_array(
+                MoodleSubmittedFile.filename, MoodleSubmittedFile.mimetype, MoodleSubmittedFile.filesize,
+                MoodleSubmittedFile.url, MoodleSubmittedFile.uploaded), type_=JSON))
+            .select_from(MoodleSubmittedFile)
+            .where(MoodleSubmittedFile.submission_id == MoodleSubmission.id)
+            .scalar_subquery()
+        )
+        stmt = (
+            select(MoodleSubmission.id, MoodleSubmission.user_id, MoodleSubmission.updated, MoodleSubmission.status,
+                   files)
+            .select_from(MoodleSubmission)
+            .where(*conditions)
+        )
+        tz = self.TZ
+        # ответов на одно задание - не более нескольких тысяч, так что они читаются без серверного курсора
+        async with self.__engine.connect() as conn:
+            result = await conn.execute(stmt)
+            # пустой подзапрос json_agg() возвращает NULL, а не пустой массив;
+            # метки времени внутри JSON приходят строками в формате ISO 8601
+            return [
+                Submission(sid, assignid, uid, updated, status, tuple(
+                    SubmittedFile(sid, fname, fmime, fsize, furl, datetime.fromisoformat(fuploaded).astimezone(tz))
+                    for fname, fmime, fsize, furl, fuploaded in sfiles or ()
                 ))
-        return [
-            Submission(
-                id=sid,
-                user_id=uid,
-                assignment_id=assignid,
-                status=status,
-                updated=updated,
-                files=tuple(files)
-            )
-            for sid, (uid, status, updated, files) in raw_subs.items()
-        ]
+                for sid, uid, updated, status, sfiles in result.all()
+            ]
+
+    async def _store_submission_batch(self, session: AsyncSession, submissions: t.Collection[Submission]) -> int:
+        """Сохраняет пакет ответов на задания и сведения о приложенных к ним файлах в рамках переданной транзакции.
+        :returns: Число сохранённых ответов (без повторов)."""
+        submissions = set(submissions)
+        if not submissions:
+            return 0
+        columns = ('id', 'assignment_id', 'user_id', 'updated', 'status')
+        await _stage_records(session, MoodleSubmission, columns,
+                             list(map(operator.attrgetter(*columns), submissions)))
+        await session.execute(_merge_staged(MoodleSubmission, columns, ('status', 'updated')))
+
+        # повторы по первичному ключу убираются заранее: ON CONFLICT DO UPDATE не может обновить строку дважды
+        files = {
+            (s.id, f.filename): (s.id, s.assignment_id, s.user_id, f.filename, f.filesize, f.mimetype, f.url, f.uploaded)
+            for s in submissions for f in s.files
+        }
+        if files:
+            columns = ('submission_id', 'assignment_id', 'user_id', 'filename', 'filesize', 'mimetype', 'url', 'uploaded')
+            await _stage_records(session, MoodleSubmittedFile, columns, files.values())
+            await session.execute(_merge_staged(MoodleSubmittedFile, columns,
+                                                ('user_id', 'filesize', 'mimetype', 'url', 'uploaded')))
+        return len(submissions)
 
     async def store_submissions(self, submissions: t.Collection[Submission]) -> None:
         """Сохраняет указанный набор ответов на задание, и сведения о приложенных к ним файлах.
         :param submissions: Ответ на задание, которые следует сохранить."""
-        submissions = set(submissions)
         if not submissions:
             return
-        async with self.__sessionmaker() as session:
-            data = [
-                dict(id=s.id, assignment_id=s.assignment_id, user_id=s.user_id,
-                     status=s.status, updated=s.updated)
-                for s in submissions
-            ]
-            stmt = upsert(MoodleSubmission)
-            stmt = stmt.on_conflict_do_update(
-                index_elements=[MoodleSubmission.id],
-                set_={
-                    MoodleSubmission.status: stmt.excluded.status,
-                    MoodleSubmission.updated: stmt.excluded.updated,
-                }
-            )
-            await session.execute(stmt, data)
-
-            data = [
-                dict(submission_id=s.id, assignment_id=s.assignment_id, user_id=s.user_id,
-                     filename=f.filename, filesize=f.filesize, mimetype=f.mimetype,
-                     url=f.url, uploaded=f.uploaded.astimezone(self.TZ))
-                for s in submissions for f in s.files
-            ]
-            if data:
-                stmt = upsert(MoodleSubmittedFile)
-                stmt = stmt.on_conflict_do_update(
-                    index_elements=[MoodleSubmittedFile.submission_id, MoodleSubmittedFile.filename],
-                    set_={
-                        MoodleSubmittedFile.user_id: stmt.excluded.user_id,
-                        MoodleSubmittedFile.filename: stmt.excluded.filename,
-                        MoodleSubmittedFile.url: stmt.excluded.url,
-                        MoodleSubmittedFile.filesize: stmt.excluded.filesize,
-                        MoodleSubmittedFile.mimetype: stmt.excluded.mimetype,
-                        MoodleSubmittedFile.uploaded: stmt.excluded.uploaded,
-                    }
-                )
-                await session.execute(stmt, data)
-            await session.commit()
+        async with self.__sessionmaker.begin() as session:
+            await self._store_submission_batch(session, submissions)
+
+    async def store_submission_batches(self, batches: t.AsyncIterable[t.Collection[Submission]]) -> int:
+        """Сохраняет ответы на задания, поступающие пакетами из асинхронного потока, в одной общей транзакции.
+        :param batches: Поток пакетов ответов для сохранения.
+        :returns: Общее число сохранённых ответов."""
+        total = 0
+        async with self.__sessionmaker.begin() as session:
+            async for submissions in batches:
+                total += await self._store_submission_batch(session, submissions)
+        return total
 
     async def drop_submissions(self, assignids: t.Collection[assignment_id], *,
                                before: datetime = None, after: datetime = None) -> None:
@@ -558,7 +688,7 @@ class MoodleRepository:
         async with self.__sessionmaker() as session:
             stmt = delete(MoodleSubmission)
             if assignids:
-                stmt = stmt.where(MoodleSubmission.assignment_id.in_(assignids))
+                stmt = stmt.where(_any_id(MoodleSubmission.assignment_id, assignids))
             if before:
                 stmt = stmt.where(MoodleSubmission.updated <= before.astimezone(self.TZ))
             if after:
@@ -574,16 +704,7 @@ class MoodleRepository:
         :returns: Словарь пар "ID задания - метка времени"."""
         if not assignids:
             return {}
-        results = {aid: None for aid in assignids}
-        async with self.__sessionmaker() as session:
-            stmt = (
-                select(MoodleSubmission.assignment_id, func.max(MoodleSubmission.updated))
-                .select_from(MoodleSubmission)
-                .where(MoodleSubmission.assignment_id.in_(assignids))
-                .group_by(MoodleSubmission.assignment_id)
-            )
-            result = await session.stream(stmt)
-            async for aid, ts in result:
-                results[aid] = ts
-        return results
+        async with self.__engine.connect() as conn:
+            result = await conn.execute(_last_submission_times_stmt(), {'ids': list(assignids)})
+            return dict(result.tuples().all())
     # endregion
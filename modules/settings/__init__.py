@@ -1,4 +1,6 @@
 """Предоставляет единый механизм хранения настроек с привязкой к отдельным сущностям."""
+import dataclasses
+
 from sqlalchemy.ext.asyncio import AsyncEngine
 
 from api import CoreAPI
@@ -10,10 +12,17 @@ requires = [AsyncEngine]
 provides = [SettingsRepository]
 
 
+@dataclasses.dataclass
+class SettingsConfig:
+    """Конфигурация хранилища настроек."""
+    cache_size: int = 1024
+
+
 async def lifetime(api: CoreAPI):
     """Тело модуля."""
+    cfg = await api.config.load('settings', SettingsConfig)
     engine = await api(AsyncEngine)
-    repo = SettingsRepository(engine)
+    repo = SettingsRepository(engine, cache_size=cfg.cache_size)
     await repo.create_tables()
     api.register_api_provider(repo, SettingsRepository)
     yield
@@ -1,6 +1,7 @@
 """Автоматически строит форму с настройками для сущности."""
 import typing as t
 import datetime
+import functools
 from html import escape
 import pydantic
 
@@ -10,25 +11,53 @@ __all__ = [
     'model2fields'
 ]
 TModel = t.TypeVar('TModel')
+# имена и заголовки полей повторяются от формы к форме и по нескольку раз в разметке одного поля,
+# так что результат их экранирования кэшируется
+_escape_label = functools.lru_cache(maxsize=8192)(escape)
 
 
 class FormPattern(t.NamedTuple):
     """Набор строк, определяющий, как отдельные поля ввода комбинируются в структуры.
     Ключ {name} соответствует имени поля, ключ {caption} - видимому заголовку поля, а ключ {input} - разметке поля.
-    Будьте осторожны и не забывайте, что name и caption должны экранироваться перед подстановкой в строку."""
+    Будьте осторожны и не забывайте, что name и caption должны экранироваться перед подстановкой в строку.
+    Необязательные render_primitive и render_compound - заранее подготовленные функции (name, caption, input),
+    дающие тот же результат, что и соответствующие строки. Они работают быстрее, чем str.format()."""
     primitive: str
     compound: str
+    render_primitive: t.Optional[t.Callable[[str, str, str], str]] = None
+    render_compound: t.Optional[t.Callable[[str, str, str], str]] = None
 
+    def format_primitive(self, name: str, caption: str, input: str) -> str:
+        """Формирует разметку отдельного поля ввода."""
+        if self.render_primitive is not None:
+            return self.render_primitive(name, caption, input)
+        return self.primitive.format(name=name, caption=caption, input=input)
 
+    def format_compound(self, name: str, caption: str, input: str) -> str:
+        """Формирует разметку группы полей ввода."""
+        if self.render_compound is not None:
+            return self.render_compound(name, caption, input)
+        return self.compound.format(name=name, caption=caption, input=input)
+
+
+# функции render_* должны давать в точности то же, что и строки primitive и compound
 DIV_PATTERN = FormPattern(
     primitive='<div class="field"><label for="{name}">{caption}</label>\n{input}</div>\n',
     compound='<section><div class="section">{caption}</div>\n{input}\n</section>\n',
+    render_primitive=lambda name, caption, input:
+        f'<div class="field"><label for="{name}">{caption}</label>\n{input}</div>\n',
+    render_compound=lambda name, caption, input:
+        f'<section><div class="section">{caption}</div>\n{input}\n</section>\n',
 )
 
 
 TABLE_PATTERN = FormPattern(
     primitive='<tr><td class="field"><label for="{name}">{caption}</label></td>\n<td>{input}</td></tr>\n',
     compound='<tr><td class="section" colspan="2"><section>{caption}<br/>\n{input}\n</section></td></tr>\n',
+    render_primitive=lambda name, caption, input:
+        f'<tr><td class="field"><label for="{name}">{caption}</label></td>\n<td>{input}</td></tr>\n',
+    render_compound=lambda name, caption, input:
+        f'<tr><td class="section" colspan="2"><section>{caption}<br/>\n{input}\n</section></td></tr>\n',
 )
 
 
@@ -44,20 +73,83 @@ def model2fields(model: TModel, pattern: FormPattern = None, toplevelcaption: st
     параметр caption содержит предпочитаемый отображаемый заголовок для  набора полей,
     а параметр pattern содержит строки, которые позволят скомпоновать отдельные наборы таблиц в единую форму.
     """
-    ta = pydantic.TypeAdapter(type(model))
-    schema = ta.json_schema()
+    schema = _model_schema(type(model))
     # import pprint
     # pprint.pprint(schema)
     return schema2fields(schema, '', model, pattern, toplevelcaption)
 
 
+@functools.cache
+def _model_schema(modeltype: type) -> dict[str, t.Any]:
+    """Строит JSON-схему модели. Схема класса не меняется, так что строится однократно для каждой модели.
+    Возвращаемый словарь общий для всех вызовов, поэтому изменять его нельзя."""
+    return pydantic.TypeAdapter(modeltype).json_schema()
+
+
+class _Section(t.NamedTuple):
+    """Группа полей (объект в схеме), ожидающая обработки вложенных полей."""
+    name: str
+    caption: str
+    value: t.Any
+    items: t.Iterator[tuple[str, dict[str, t.Any]]]
+    parts: list[str]
+
+
 def schema2fields(schema: dict[str, t.Any], name: str, value: t.Any,
                   pattern: FormPattern = None, toplevelcaption: str = None, defs: dict[str, t.Any] = None) -> str:
-    """Подготавливает набор полей на основании схемы."""
+    """Подготавливает набор полей на основании схемы.
+    Вложенные объекты обходятся с помощью явного стека, а не рекурсии, так что глубина вложенности моделей
+    не ограничена глубиной стека вызовов. Ошибка при построении вложенного поля выводится, а само поле пропускается."""
     if defs is None:
         defs = schema.get('$defs', {})
     if pattern is None:
         pattern = DIV_PATTERN
+    root = _schema2node(schema, name, value, pattern, toplevelcaption)
+    if isinstance(root, str):
+        return root
+    stack = [root]
+    while True:
+        section = stack[-1]
+        entry = next(section.items, None)
+        if entry is None:  # все поля группы обработаны - собираем её разметку и передаём родителю
+            stack.pop()
+            try:
+                part = pattern.format_compound(name=section.name, caption=section.caption,
+                                               input='\n'.join(section.parts))
+            except Exception as err:
+                if not stack:
+                    raise
+                print(err)
+                continue
+            if not stack:
+                return part
+            stack[-1].parts.append(part)
+            continue
+        item, itemschema = entry
+        try:
+            itemname = f'{section.name}[{item}]' if section.name else item
+            itemvalue = getattr(section.value, item)
+            itemcaption = itemschema.get('description', None)
+            if '$ref' in itemschema:
+                itempath: str = itemschema['$ref']
+                itempath = itempath[len('#/$defs/'):]
+                itemschema = defs[itempath]
+                if itemcaption is None:
+                    itemcaption = itemschema.get('description', None)
+            node = _schema2node(itemschema, itemname, itemvalue, pattern, itemcaption)
+        except Exception as err:
+            print(err)
+        else:
+            if isinstance(node, str):
+                section.parts.append(node)
+            else:
+                stack.append(node)
+
+
+def _schema2node(schema: dict[str, t.Any], name: str, value: t.Any,
+                 pattern: FormPattern, toplevelcaption: t.Optional[str]) -> t.Union[str, _Section]:
+    """Формирует разметку одного поля на основании схемы.
+    Для объекта возвращает группу, вложенные поля которой ещё предстоит обработать."""
     optional, stype = schema2type(schema)
     caption = next((c for c in [
         toplevelcaption,
@@ -71,25 +163,7 @@ def schema2fields(schema: dict[str, t.Any], name: str, value: t.Any,
         return value.generate_fields(name, optional, caption, pattern)
 
     if stype == 'object':
-        parts = []
-        props = schema['properties']
-        for item, itemschema in props.items():
-            try:
-                itemname = f'{name}[{item}]' if name else item
-                itemvalue = getattr(value, item)
-                itemcaption = itemschema.get('description', None)
-                if '$ref' in itemschema:
-                    itempath: str = itemschema['$ref']
-                    itempath = itempath[len('#/$defs/'):]
-                    itemschema = defs[itempath]
-                    if itemcaption is None:
-                        itemcaption = itemschema.get('description', None)
-                part = schema2fields(itemschema, itemname, itemvalue, pattern, itemcaption, defs)
-            except Exception as err:
-                print(err)
-            else:
-                parts.append(part)
-        return pattern.compound.format(name=name, caption=caption, input='\n'.join(parts))
+        return _Section(name, caption, value, iter(schema['properties'].items()), [])
     if stype == 'integer':
         input_code = schema2field_int(schema, name, optional, value)
     elif stype == 'number':
@@ -117,53 +191,100 @@ def schema2fields(schema: dict[str, t.Any], name: str, value: t.Any,
             input_code = schema2field_uri(schema, name, optional, value)
         else:
             raise TypeError(f'Unsupported format: {fmt}')
-    return pattern.primitive.format(input=input_code, caption=escape(caption), name=escape(name))
+    return pattern.format_primitive(name=_escape_label(name), caption=_escape_label(caption), input=input_code)
+
+
+class _SchemaRef:
+    """Позволяет использовать узел схемы (словарь) как ключ кэша: сравнение выполняется по идентичности.
+    Кэш хранит ссылку на ключ, а значит и на сам узел, так что его id не может достаться другому словарю."""
+    __slots__ = ('schema',)
+
+    def __init__(self, schema: dict[str, t.Any]):
+        self.schema = schema
+
+    def __hash__(self) -> int:
+        return id(self.schema)
+
+    def __eq__(self, other: t.Any) -> bool:
+        return isinstance(other, _SchemaRef) and other.schema is self.schema
+
+
+@functools.lru_cache(maxsize=4096)
+def _static_markup(builder: t.Callable[[dict[str, t.Any], str, bool], str],
+                   ref: _SchemaRef, name: str, optional: bool) -> str:
+    """Кэширует часть разметки поля, зависящую только от схемы, имени и обязательности поля, но не от значения.
+    Схемы моделей строятся однократно (см. _model_schema()), так что при повторном выводе формы
+    остаётся только подставить значения."""
+    return builder(ref.schema, name, optional)
+
+
+def _enum_options(schema: dict[str, t.Any], _name: str, optional: bool) -> str:
+    """Формирует варианты выбора для перечисления, ни один из которых не выбран."""
+    options = [f'<option >{escape(v)}</option>' for v in schema['enum']]
+    if optional:
+        options.insert(0, '<option  value="">---</option>')
+    return "".join(options)
 
 
 def schema2field_enum(schema: dict[str, t.Any], name: str, optional: bool, value: t.Optional[str]) -> str:
     """Формирует поле ввода перечисления."""
-    attrs = [f'name="{escape(name)}"', f'id="{escape(name)}"', 'size="1"']
-    options = [
-        f'<option {"selected" if value == v else ""}>{escape(v)}</option>'
-        for v in schema['enum']
-    ]
-    if optional:
-        options.insert(0, f'<option {"selected" if value is None else ""} value="">---</option>')
-    else:
+    ename = _escape_label(name)
+    options = _static_markup(_enum_options, _SchemaRef(schema), name, optional)
+    # выбранный вариант отмечается заменой в заранее подготовленном списке
+    if value is None and optional:
+        options = options.replace('<option  value="">', '<option selected value="">', 1)
+    elif value in schema['enum']:
+        evalue = escape(value)
+        options = options.replace(f'<option >{evalue}</option>', f'<option selected>{evalue}</option>', 1)
+    return f'<select name="{ename}" id="{ename}" size="1"{"" if optional else " required"}>{options}</select>'
+
+
+def _uri_attrs(_schema: dict[str, t.Any], name: str, optional: bool) -> str:
+    """Формирует неизменные атрибуты поля ввода URL."""
+    attrs = ['type="url"', f'name="{_escape_label(name)}"', f'id="{_escape_label(name)}"']
+    if not optional:
         attrs.append('required')
-    return f'<select {" ".join(attrs)}>{"".join(options)}</select>'
+    return " ".join(attrs)
 
 
-def schema2field_uri(_schema: dict[str, t.Any], name: str, optional: bool, value: t.Optional[str]) -> str:
+def schema2field_uri(schema: dict[str, t.Any], name: str, optional: bool, value: t.Optional[str]) -> str:
     """Формирует поле ввода URL."""
-    attrs = ['type="url"', f'name="{escape(name)}"', f'id="{escape(name)}"']
-    if not optional:
-        attrs.append('required')
+    attrs = _static_markup(_uri_attrs, _SchemaRef(schema), name, optional)
     value = str(value) if value is not None else ''
-    attrs.append(f'value="{escape(value)}"')
-    return f'<input {" ".join(attrs)}/>'
+    return f'<input {attrs} value="{escape(value)}"/>'
 
 
-def schema2field_email(_schema: dict[str, t.Any], name: str, optional: bool, value: t.Optional[str]) -> str:
-    """Формирует поле ввода почтового адреса."""
-    attrs = ['type="email"', f'name="{escape(name)}"', f'id="{escape(name)}"']
+def _email_attrs(_schema: dict[str, t.Any], name: str, optional: bool) -> str:
+    """Формирует неизменные атрибуты поля ввода почтового адреса."""
+    attrs = ['type="email"', f'name="{_escape_label(name)}"', f'id="{_escape_label(name)}"']
     if not optional:
         attrs.append('required')
+    return " ".join(attrs)
+
+
+def schema2field_email(schema: dict[str, t.Any], name: str, optional: bool, value: t.Optional[str]) -> str:
+    """Формирует поле ввода почтового адреса."""
+    attrs = _static_markup(_email_attrs, _SchemaRef(schema), name, optional)
     value = str(value) if value is not None else ''
-    attrs.append(f'value="{escape(value)}"')
-    return f'<input {" ".join(attrs)}/>'
+    return f'<input {attrs} value="{escape(value)}"/>'
 
 
-def schema2field_timedelta(
-        _schema: dict[str, t.Any], name: str, optional: bool, value: t.Optional[datetime.timedelta]) -> str:
-    """Формирует поле ввода интервала времени."""
+def _timedelta_attrs(_schema: dict[str, t.Any], name: str, optional: bool) -> str:
+    """Формирует неизменные атрибуты поля ввода интервала времени."""
     attrs = [
-        'type="text"', f'name="{escape(name)}"', f'id="{escape(name)}"',
+        'type="text"', f'name="{_escape_label(name)}"', f'id="{_escape_label(name)}"',
         r'pattern="\s*(\d+\s*[дd]\w*\s*)?\d+:\d+(:\d+(.\d+)?)?\s*"',
         'title="Пример: 3 д 12:34:56"'
     ]
     if not optional:
         attrs.append('required')
+    return " ".join(attrs)
+
+
+def schema2field_timedelta(
+        schema: dict[str, t.Any], name: str, optional: bool, value: t.Optional[datetime.timedelta]) -> str:
+    """Формирует поле ввода интервала времени."""
+    attrs = _static_markup(_timedelta_attrs, _SchemaRef(schema), name, optional)
     if value is not None:
         svalue = f'{value.days} д ' if value.days != 0 else ''
         svalue += f'{value.seconds // 3600:02d}:{(value.seconds % 3600) // 60:02d}:{value.seconds % 60:02d}'
@@ -171,24 +292,28 @@ def schema2field_timedelta(
         value = svalue
     else:
         value = ''
-    attrs.append(f'value="{value}"')
-    return f'<input {" ".join(attrs)}/>'
+    return f'<input {attrs} value="{value}"/>'
 
 
-def schema2field_datetime(_schema: dict[str, t.Any], name: str, optional: bool, value: t.Optional[datetime.datetime]
-                          ) -> str:
-    """Формирует поле ввода даты-времени."""
-    attrs = ['type="datetime-local"', f'name="{escape(name)}"', f'id="{escape(name)}"']
+def _datetime_attrs(_schema: dict[str, t.Any], name: str, optional: bool) -> str:
+    """Формирует неизменные атрибуты поля ввода даты-времени."""
+    attrs = ['type="datetime-local"', f'name="{_escape_label(name)}"', f'id="{_escape_label(name)}"']
     if not optional:
         attrs.append('required')
+    return " ".join(attrs)
+
+
+def schema2field_datetime(schema: dict[str, t.Any], name: str, optional: bool, value: t.Optional[datetime.datetime]
+                          ) -> str:
+    """Формирует поле ввода даты-времени."""
+    attrs = _static_markup(_datetime_attrs, _SchemaRef(schema), name, optional)
     value = value.isoformat(timespec='seconds') if value is not None else ''
-    attrs.append(f'value="{value}"')
-    return f'<input {" ".join(attrs)}/>'
+    return f'<input {attrs} value="{value}"/>'
 
 
-def schema2field_text(schema: dict[str, t.Any], name: str, _optional: bool, value: t.Optional[bool]) -> str:
-    """Формирует поле ввода многострочного текста."""
-    attrs = [f'name="{escape(name)}"', f'id="{escape(name)}"']
+def _text_attrs(schema: dict[str, t.Any], name: str, _optional: bool) -> str:
+    """Формирует неизменные атрибуты поля ввода многострочного текста."""
+    attrs = [f'name="{_escape_label(name)}"', f'id="{_escape_label(name)}"']
     if 'examples' in schema:
         ex = '; '.join(map(str, schema['examples']))
         attrs.append(f'title="{escape(ex)}"')
@@ -196,13 +321,19 @@ def schema2field_text(schema: dict[str, t.Any], name: str, _optional: bool, valu
         attrs.append(f'minlength="{int(schema["minLength"])}"')
     if 'maxLength' in schema:
         attrs.append(f'maxlength="{int(schema["maxLength"])}"')
+    return " ".join(attrs)
+
+
+def schema2field_text(schema: dict[str, t.Any], name: str, optional: bool, value: t.Optional[bool]) -> str:
+    """Формирует поле ввода многострочного текста."""
+    attrs = _static_markup(_text_attrs, _SchemaRef(schema), name, optional)
     value = str(value) if value is not None else ''
-    return f'<textarea {" ".join(attrs)}>{escape(value)}</textarea>'
+    return f'<textarea {attrs}>{escape(value)}</textarea>'
 
 
-def schema2field_str(schema: dict[str, t.Any], name: str, optional: bool, value: t.Optional[bool]) -> str:
-    """Формирует поле ввода обычной строки."""
-    attrs = ['type="text"', f'name="{escape(name)}"', f'id="{escape(name)}"']
+def _str_attrs(schema: dict[str, t.Any], name: str, optional: bool) -> str:
+    """Формирует неизменные атрибуты поля ввода обычной строки."""
+    attrs = ['type="text"', f'name="{_escape_label(name)}"', f'id="{_escape_label(name)}"']
     if 'examples' in schema:
         ex = '; '.join(map(str, schema['examples']))
         attrs.append(f'title="{escape(ex)}"')
@@ -214,28 +345,31 @@ def schema2field_str(schema: dict[str, t.Any], name: str, optional: bool, value:
         attrs.append(f'pattern="{escape(schema["pattern"])}"')
     if not optional:
         attrs.append('required')
+    return " ".join(attrs)
+
+
+def schema2field_str(schema: dict[str, t.Any], name: str, optional: bool, value: t.Optional[bool]) -> str:
+    """Формирует поле ввода обычной строки."""
+    attrs = _static_markup(_str_attrs, _SchemaRef(schema), name, optional)
     value = str(value) if value is not None else ''
-    attrs.append(f'value="{escape(value)}"')
-    return f'<input {" ".join(attrs)}/>'
+    return f'<input {attrs} value="{escape(value)}"/>'
 
 
 def schema2field_bool(_schema: dict[str, t.Any], name: str, optional: bool, value: t.Optional[bool]) -> str:
     """Формирует поле ввода логического значения."""
-    attrs = [f'name="{escape(name)}"', f'id="{escape(name)}"', 'size="1"']
-    options = [
-        f'<option {"selected" if bool(value) else ""} value="1">Да</option>',
-        f'<option {"selected" if value is not None and not bool(value) else ""} value="0">Нет</option>',
-    ]
-    if optional:
-        options.insert(0, f'<option {"selected" if value is None else ""} value="null">---</option>')
-    else:
-        attrs.append('required')
-    return f'<select {" ".join(attrs)}>{"".join(options)}</select>'
-
-
-def schema2field_float(schema: dict[str, t.Any], name: str, optional: bool, value: t.Optional[float]) -> str:
-    """Формирует поле ввода дробного числа."""
-    attrs = ['type="number"', f'name="{escape(name)}"', f'id="{escape(name)}"']
+    ename = _escape_label(name)
+    return (
+        f'<select name="{ename}" id="{ename}" size="1"{"" if optional else " required"}>'
+        + (f'<option {"selected" if value is None else ""} value="null">---</option>' if optional else '')
+        + f'<option {"selected" if bool(value) else ""} value="1">Да</option>'
+        + f'<option {"selected" if value is not None and not bool(value) else ""} value="0">Нет</option>'
+        + '</select>'
+    )
+
+
+def _float_attrs(schema: dict[str, t.Any], name: str, optional: bool) -> str:
+    """Формирует неизменные атрибуты поля ввода дробного числа."""
+    attrs = ['type="number"', f'name="{_escape_label(name)}"', f'id="{_escape_label(name)}"']
     if 'minimum' in schema:
         attrs.append(f'min="{schema["minimum"]}"')
     elif 'exclusiveMinimum' in schema:
@@ -248,14 +382,19 @@ def schema2field_float(schema: dict[str, t.Any], name: str, optional: bool, valu
         attrs.append(f'max="{emax * 1.000001 if emax < 0 else emax * 0.999999 if emax > 0 else -0.000001}"')
     if not optional:
         attrs.append('required')
+    return " ".join(attrs)
+
+
+def schema2field_float(schema: dict[str, t.Any], name: str, optional: bool, value: t.Optional[float]) -> str:
+    """Формирует поле ввода дробного числа."""
+    attrs = _static_markup(_float_attrs, _SchemaRef(schema), name, optional)
     value = float(value) if value is not None else ''
-    attrs.append(f'value="{value}"')
-    return f'<input {" ".join(attrs)}/>'
+    return f'<input {attrs} value="{value}"/>'
 
 
-def schema2field_int(schema: dict[str, t.Any], name: str, optional: bool, value: t.Optional[int]) -> str:
-    """Формирует поле ввода целого числа."""
-    attrs = ['type="number"', f'name="{escape(name)}"', f'id="{escape(name)}"', 'step="1"']
+def _int_attrs(schema: dict[str, t.Any], name: str, optional: bool) -> str:
+    """Формирует неизменные атрибуты поля ввода целого числа."""
+    attrs = ['type="number"', f'name="{_escape_label(name)}"', f'id="{_escape_label(name)}"', 'step="1"']
     if 'minimum' in schema:
         attrs.append(f'min="{schema["minimum"]}"')
     elif 'exclusiveMinimum' in schema:
@@ -266,9 +405,14 @@ def schema2field_int(schema: dict[str, t.Any], name: str, optional: bool, value:
         attrs.append(f'max="{schema["exclusiveMaximum"] - 1}"')
     if not optional:
         attrs.append('required')
+    return " ".join(attrs)
+
+
+def schema2field_int(schema: dict[str, t.Any], name: str, optional: bool, value: t.Optional[int]) -> str:
+    """Формирует поле ввода целого числа."""
+    attrs = _static_markup(_int_attrs, _SchemaRef(schema), name, optional)
     value = int(value) if value is not None else ''
-    attrs.append(f'value="{value}"')
-    return f'<input {" ".join(attrs)}/>'
+    return f'<input {attrs} value="{value}"/>'
 
 
 def schema2type(schema: dict[str, t.Any]) -> tuple[bool, str]:
@@ -277,12 +421,9 @@ def schema2type(schema: dict[str, t.Any]) -> tuple[bool, str]:
     if 'type' in schema:
         stype = schema['type']
     elif 'anyOf' in schema:
-        options: list[dict[str, t.Any]] = schema['anyOf']
-        for opt in options:
-            if opt['type'] == 'null':
-                optional = True
-                options.remove(opt)
-                break
+        # схема может быть общей для нескольких вызовов (см. _model_schema()), так что не изменяем её
+        options: list[dict[str, t.Any]] = [opt for opt in schema['anyOf'] if opt['type'] != 'null']
+        optional = len(options) < len(schema['anyOf'])
         if len(options) == 1:
             stype = options[0]['type']
         else:
@@ -1,5 +1,7 @@
 """Модели для хранения настроек."""
 from typing import Any, TypeVar, Type, Optional
+import collections
+import functools
 
 import pydantic
 from sqlalchemy import JSON, select, delete, String
@@ -14,6 +16,13 @@ __all__ = ['SettingsRepository']
 TModel = TypeVar('TModel')
 
 
+@functools.cache
+def _adapter(modeltype: Type[TModel]) -> pydantic.TypeAdapter[TModel]:
+    """Возвращает адаптер для модели настроек. Адаптер создаётся однократно для каждой модели,
+    так как его построение (сборка схемы валидации) обходится намного дороже самой валидации."""
+    return pydantic.TypeAdapter(modeltype)
+
+
 class Settings(DBModel):
     """Набор настроек, привязанных к сущности.
 
@@ -34,9 +43,20 @@ class Settings(DBModel):
 
 
 class SettingsRepository:
-    """Предоставляет доступ к хранилищу настроек."""
-    def __init__(self, engine: AsyncEngine):
+    """Предоставляет доступ к хранилищу настроек.
+
+    Последние прочитанные настройки кэшируются в памяти процесса (не более cache_size записей,
+    вытесняются давно не использовавшиеся). Кэш сбрасывается только изменениями через этот же экземпляр,
+    поэтому изменения, внесённые в БД другим процессом, видны не будут."""
+    def __init__(self, engine: AsyncEngine, cache_size: int = 1024):
         self.__known_models: dict[Type[TModel], tuple[str, str]] = {}
+        # кэш сохранённых настроек: (модель, ID сущности) -> данные из БД (None - настроек нет), в порядке использования.
+        # хранятся данные, а не экземпляры моделей, так как модели изменяемы и каждый вызов get() получает свою копию
+        self.__cache: collections.OrderedDict[tuple[Type[TModel], str], Optional[Any]] = collections.OrderedDict()
+        self.__cache_size = max(0, cache_size)
+        # увеличивается при каждом изменении настроек. get() не кэширует результат, если во время его запроса
+        # настройки успели измениться, - иначе в кэш могли бы попасть устаревшие данные
+        self.__generation = 0
         self.__sessionmaker = async_sessionmaker(bind=engine, class_=AsyncSession,
                                                  autoflush=True, expire_on_commit=False)
 
@@ -74,6 +94,17 @@ class SettingsRepository:
         else:
             return usage
 
+    def __invalidate(self, namespace: str, entity_type: Optional[str], entity_id: Optional[str]) -> None:
+        """Удаляет из кэша настройки, затронутые изменением. Вызывается и до, и после фиксации изменения в БД,
+        чтобы get(), выполнявшийся одновременно с изменением, не поместил в кэш устаревшие данные.
+        Значения None для entity_type и entity_id означают "все"."""
+        self.__generation += 1
+        for key in list(self.__cache):
+            modeltype, eid = key
+            ns, etype = self.__known_models[modeltype]
+            if ns == namespace and entity_type in (None, etype) and (entity_type is None or entity_id in (None, eid)):
+                del self.__cache[key]
+
     async def create_tables(self) -> None:
         """Создаёт таблицу для хранения настроек."""
         engine: AsyncEngine = self.__sessionmaker.kw['bind']
@@ -89,18 +120,27 @@ class SettingsRepository:
         :returns: Экземпляр модели настроек, зарегистрированной для этой сущности.
         """
         namespace, entity_type = self.get_model_usage(modeltype)
-        stmt = select(Settings.data).select_from(Settings).where(
-            Settings.namespace == namespace,
-            Settings.entity_type == entity_type,
-            Settings.entity_id == entity_id
-        )
-        async with self.__sessionmaker() as session:
-            data = await session.scalar(stmt)
+        key = (modeltype, entity_id)
+        if key in self.__cache:
+            self.__cache.move_to_end(key)
+            data = self.__cache[key]
+        else:
+            stmt = select(Settings.data).select_from(Settings).where(
+                Settings.namespace == namespace,
+                Settings.entity_type == entity_type,
+                Settings.entity_id == entity_id
+            )
+            generation = self.__generation
+            async with self.__sessionmaker() as session:
+                data = await session.scalar(stmt)
+            if generation == self.__generation and self.__cache_size > 0:
+                self.__cache[key] = data
+                if len(self.__cache) > self.__cache_size:
+                    self.__cache.popitem(last=False)
         if data is None:
             return modeltype()
         else:
-            ta = pydantic.TypeAdapter(modeltype)
-            return ta.validate_python(data)
+            return _adapter(modeltype).validate_python(data)
 
     async def set(self, entity_id: str, data: TModel) -> None:
         """Сохраняет настройки для указанной сущности.
@@ -111,19 +151,20 @@ class SettingsRepository:
         """
         modeltype = type(data)
         namespace, entity_type = self.get_model_usage(modeltype)
-        adapter = pydantic.TypeAdapter(modeltype)
         stmt = upsert(Settings).values({
             Settings.namespace: namespace,
             Settings.entity_type: entity_type,
             Settings.entity_id: entity_id,
-            Settings.data: adapter.dump_python(data)
+            Settings.data: _adapter(modeltype).dump_python(data)
         })
         stmt = stmt.on_conflict_do_update(
             index_elements=[Settings.namespace, Settings.entity_type, Settings.entity_id],
             set_={Settings.data: stmt.excluded.data}
         )
-        async with self.__sessionmaker() as session:
+        self.__invalidate(namespace, entity_type, entity_id)
+        async with self.__sessionmaker.begin() as session:
             await session.execute(stmt)
+        self.__invalidate(namespace, entity_type, entity_id)
 
     async def delete_for(self, namespace: str, entity_type: Optional[str], entity_id: Optional[str]) -> None:
         """Удаляет настройки для указанной сущности, типа сущностей или все настройки из заданного пространства имён.
@@ -134,13 +175,17 @@ class SettingsRepository:
         :param entity_id: ID сущности, для которой удаляются настройки. Если None, будут удалены настройки
         для всех экземпляров указанного типа сущностей.
         """
-        stmt = delete(Settings).where(Settings.namespace == namespace.lower())
+        namespace = namespace.lower()
+        entity_type = entity_type.lower() if entity_type is not None else None
+        stmt = delete(Settings).where(Settings.namespace == namespace)
         if entity_type is not None:
-            stmt = stmt.where(Settings.entity_type == entity_type.lower())
+            stmt = stmt.where(Settings.entity_type == entity_type)
             if entity_id is not None:
                 stmt = stmt.where(Settings.entity_id == entity_id)
-        async with self.__sessionmaker() as session:
+        self.__invalidate(namespace, entity_type, entity_id)
+        async with self.__sessionmaker.begin() as session:
             await session.execute(stmt)
+        self.__invalidate(namespace, entity_type, entity_id)
 
     async def delete(self, modeltype: Type[TModel], entity_id: Optional[str]) -> None:
         """Удаляет настройки для указанной сущности или типа сущностей.
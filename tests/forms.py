@@ -1,8 +1,11 @@
+import copy
 import enum
+import typing as t
 
 from pydantic import BaseModel, Field
 
 from modules.settings.forms import model2fields
+from modules.settings.forms.generation import schema2type
 
 
 def test_simplemodel():
@@ -24,5 +27,25 @@ def test_simplemodel():
     print(model2fields(Line(start=Point(x=0, y=0), end=Point(x=1, y=1), color=Color.BLUE)))
 
 
+def test_schema2type_keeps_schema():
+    schema = {'anyOf': [{'type': 'integer'}, {'type': 'null'}]}
+    original = copy.deepcopy(schema)
+    assert schema2type(schema) == (True, 'integer')
+    # схемы кэшируются, поэтому повторный разбор той же схемы должен давать тот же результат
+    assert schema == original
+    assert schema2type(schema) == (True, 'integer')
+
+
+def test_optional_field_stable():
+    class Limits(BaseModel):
+        count: t.Optional[int] = Field(default=None, description="Количество")
+
+    first = model2fields(Limits())
+    second = model2fields(Limits())
+    assert first == second
+
+
 if __name__ == '__main__':
     test_simplemodel()
+    test_schema2type_keeps_schema()
+    test_optional_field_stable()
@@ -0,0 +1,27 @@
+from modules.moodle import User, Role
+
+
+def test_id_equality():
+    a = User(id=1, name='Иванов', email='a@example.com')
+    b = User(id=1, name='Иванов И.И.')
+    c = User(id=2, name='Иванов')
+    # сущности сравниваются только по ID
+    assert a == b and not (a != b)
+    assert a != c and not (a == c)
+    assert hash(a) == hash(b)
+    assert len({a, b, c}) == 2
+
+
+def test_id_equality_other_types():
+    user = User(id=1, name='Иванов')
+    role = Role(id=1, name='student')
+    # одинаковый ID у сущностей разных типов не делает их равными
+    assert user != role and not (user == role)
+    assert user != 1 and not (user == 1)
+    assert len({user, role}) == 2
+
+
+if __name__ == '__main__':
+    test_id_equality()
+    test_id_equality_other_types()
+    print('OK')
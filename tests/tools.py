@@ -0,0 +1,32 @@
+import asyncio
+
+from api import aiobatch
+
+
+async def _numbers(count: int):
+    for i in range(count):
+        yield i
+
+
+async def _collect(count: int, batch_size: int) -> list[list[int]]:
+    return [batch async for batch in aiobatch(_numbers(count), batch_size)]
+
+
+def test_aiobatch_sizes():
+    assert asyncio.run(_collect(7, 3)) == [[0, 1, 2], [3, 4, 5], [6]]
+    assert asyncio.run(_collect(6, 3)) == [[0, 1, 2], [3, 4, 5]]
+    assert asyncio.run(_collect(0, 3)) == []
+    assert asyncio.run(_collect(3, 0)) == [[0], [1], [2]]
+
+
+def test_aiobatch_no_aliasing():
+    # получатель может сохранять пакеты - последующие пакеты не должны их перезаписывать
+    batches = asyncio.run(_collect(5, 2))
+    assert batches == [[0, 1], [2, 3], [4]]
+    assert len({id(batch) for batch in batches}) == len(batches)
+
+
+if __name__ == '__main__':
+    test_aiobatch_sizes()
+    test_aiobatch_no_aliasing()
+    print('OK')